@@ -8,11 +8,11 @@ from argparse import ArgumentParser
 import pickle
 import os
 import yaml
-from copy import deepcopy
 from glob import glob
 from scipy.special import softmax
 from functools import reduce
 from utils import *
+from dirichlet import fit_tau_family
 
 from joblib import Parallel, delayed
 
@@ -27,6 +27,8 @@ if __name__ == "__main__":
     parser.add_argument("--iters", type=int, default=100)
     parser.add_argument("--resultsdir", type=str, default="results")
     parser.add_argument("--knn", type=int, default=0)
+    parser.add_argument("--taufamily", action="store_true", help="evaluate all Dirichlet accuracy models together, with one multi-shift solve per step (see dirichlet.fit_tau_family). Fewer matrix-vector products, but slower in wall time for the 4 taus of utils.MODELS, only faster for about 8 or more")
+    parser.add_argument("--propcache", type=float, default=0., help="size cap in GiB of the on-disk propagation store of each Dirichlet model (one per tau, see cache.prop_store), 0 to not store propagations")
     args = parser.parse_args()
 
     # load in configuration file
@@ -35,8 +37,9 @@ if __name__ == "__main__":
 
     G, labels, trainset, normalization = load_graph(args.dataset, args.metric, numeigs=None) # don't compute any eigenvalues
     model_names = [name for name in config["acc_models"] if name[:3] != "gcn"]
-    models = get_models(G, model_names)
-    models_dict = {name:model for name, model in zip(model_names, models)}
+    unknown = [name for name in model_names if name not in MODELS]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown accuracy models {unknown}, choose from {list(MODELS.keys())}")
     results_directories = glob(os.path.join(args.resultsdir, f"{args.dataset}_results_*_{args.iters}/"))
     acqs_models = config["acqs_models"]
     
@@ -48,10 +51,17 @@ if __name__ == "__main__":
         choices_fnames = [fname for fname in choices_fnames if " ".join(fname.split("_")[-2:]).split(".")[0] in acqs_models ]
         labeled_ind = np.load(os.path.join(RESULTS_DIR, "init_labeled.npy")) # initially labeled points that are common to all acq_func:gbssl modelname pairs
         
-        for num, acc_model_name in enumerate(models_dict.keys()):
-            acc_dir = os.path.join(RESULTS_DIR, acc_model_name)
-            if not os.path.exists(acc_dir):
-                os.makedirs(acc_dir)
+        # accuracy models evaluated together, by default one at a time
+        groups = [[name] for name in model_names]
+        if args.taufamily: # the Dirichlet models (see utils.MODELS), by name so that no model is built here
+            family = [name for name in model_names if name.startswith("dirichlet")]
+            groups = [[name] for name in model_names if name not in family] + ([family] if len(family) > 0 else [])
+
+        for num, group in enumerate(groups):
+            for acc_model_name in group:
+                acc_dir = os.path.join(RESULTS_DIR, acc_model_name)
+                if not os.path.exists(acc_dir):
+                    os.makedirs(acc_dir)
 
             def compute_accuracies(choices_fname):
                 # get acquisition function - gbssl modelname that made this sequence of choices
@@ -61,29 +71,38 @@ if __name__ == "__main__":
                 # load in the indices of the choices
                 choices = np.load(choices_fname)
 
-                # define the filepath of where the results of evaluating this acq_func:modelname combo had in acc_model_name
-                acc_fname = os.path.join(acc_dir, f"acc_{acq_func_name}_{modelname}.npy")
-                if os.path.exists(acc_fname):
-                    print(f"Already computed accuracies in {acc_model_name} for {acc_fname}")
+                # define the filepaths of where the results of evaluating this acq_func:modelname combo had in each acc_model_name
+                acc_fnames = {}
+                for acc_model_name in group:
+                    acc_fname = os.path.join(RESULTS_DIR, acc_model_name, f"acc_{acq_func_name}_{modelname}.npy")
+                    if os.path.exists(acc_fname) and not np.isnan(np.load(acc_fname)).any(): # test_al_gl.py --evalevery leaves NaNs
+                        print(f"Already computed accuracies in {acc_model_name} for {acc_fname}")
+                    else:
+                        acc_fnames[acc_model_name] = acc_fname
+                if len(acc_fnames) == 0:
                     return
-                else:
-                    print(f"Computing accuracies in {acc_model_name} for {acq_func_name} in {modelname}")
+                print(f"Computing accuracies in {', '.join(acc_fnames.keys())} for {acq_func_name} in {modelname}")
 
-                # get copy of model on this cpu
-                model = deepcopy(models_dict[acc_model_name])
+                # new models on this cpu, sharing the graph
+                models = get_models(G, list(acc_fnames.keys()), propcache=args.propcache)
                 
                 # Compute accuracies at each sequential subset of choices
-                acc = np.array([])
+                accs = [np.array([]) for model in models]
                 for j in tqdm(range(labeled_ind.size,choices.size+1), desc=f"Computing Acc of {acq_func_name}-{modelname}"):
                     train_ind = choices[:j]
-                    u = model.fit(train_ind, labels[train_ind])
-                    acc = np.append(acc, gl.ssl.ssl_accuracy(model.predict(), labels, train_ind))
-
-                # save accuracy results to corresponding filename
-                np.save(acc_fname, acc)
+                    if len(models) > 1:
+                        fit_tau_family(models, train_ind, labels[train_ind]) # one multi-shift solve for all taus
+                    else:
+                        models[0].fit(train_ind, labels[train_ind])
+                    for k, model in enumerate(models):
+                        accs[k] = np.append(accs[k], gl.ssl.ssl_accuracy(model.predict(), labels, train_ind))
+
+                # save accuracy results to corresponding filenames
+                for acc_fname, acc in zip(acc_fnames.values(), accs):
+                    np.save(acc_fname, acc)
                 return
 
-            print(f"-------- Computing Accuracies in {acc_model_name}, {num+1}/{len(models_dict)} in {RESULTS_DIR} ({out_num+1}/{len(results_directories)}) -------")
+            print(f"-------- Computing Accuracies in {', '.join(group)}, {num+1}/{len(groups)} in {RESULTS_DIR} ({out_num+1}/{len(results_directories)}) -------")
 
             Parallel(n_jobs=args.numcores)(delayed(compute_accuracies)(choices_fname) for choices_fname \
                     in choices_fnames)
@@ -91,7 +110,7 @@ if __name__ == "__main__":
 
         # Consolidate results
         print(f"Consolidating accuracy results of run in: {os.path.join(RESULTS_DIR)}...")
-        for acc_model_name in models_dict.keys():
+        for acc_model_name in model_names:
             acc_dir = os.path.join(RESULTS_DIR, acc_model_name)
             accs_fnames = glob(os.path.join(acc_dir, "acc_*.npy"))
             columns = {}
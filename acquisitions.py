@@ -1,5 +1,8 @@
 from graphlearning.active_learning import acquisition_function
 import numpy as np
+import heapq
+from solvers import covariance_operator
+from dirichlet import posterior_variance
 
 class dirichlet_var(acquisition_function):
     '''
@@ -8,15 +11,133 @@ class dirichlet_var(acquisition_function):
     Note: u now is actually the matrix A in Dirichlet Learning. Need to ensure
     '''
     def compute(self, u, candidate_ind):
-        a0 = u.sum(axis=1)
-        a = (u * u).sum(axis=1)
-        return ((1. - a/(a0**2.))/(1. + a0))[candidate_ind]
+        return posterior_variance(u[candidate_ind]) # only the candidate rows (u may be a lazy dirichlet.dirichlet_posterior)
 
-class dirichlet_varprop(acquisition_function):
+class dirichlet_var_index(acquisition_function):
+    '''
+    Dirichlet Learning Variance, maintained incrementally in a max-heap. Only for models with truncated propagations
+    (sparse_topk or sparse_thresh of dirichlet.dirichlet_learning), with dense ones every row changes on every fit.
+
+    After each fit only the rows of A it touched (the posterior's last_change) are checked, and rescored if their
+    accumulated change may have moved the variance by more than tol (a change e of a row with sum s moves the mean 
+    estimator, and so the variance, by at most 2e/(s - e) in l1). select pops the top candidates off the heap, lazily
+    discarding outdated entries, and keeps a bitmap of the candidates from which update removes the labeled nodes. 
+    So a query costs O(rows touched + batch_size log n) instead of O(n), as long as candidate_ind is the previous 
+    candidates without the labeled nodes (other candidate sets, e.g. pruned ones, are rebuilt in O(n)). Values agree
+    with dirichlet_var up to tol.
     '''
+    def __init__(self, tol=1e-4):
+        self.tol = tol
+        self.A = None
+        self.is_candidate = None
+
+    def _refresh(self, u):
+        if getattr(u, 'last_change', None) is None:
+            raise ValueError("dirichlet_var_index needs a dirichlet_learning model with truncated propagations "
+                             "(sparse_topk or sparse_thresh), use dirichlet_var otherwise")
+        if (u.A is self.A) and (u.version == self.version):
+            return
+        if (u.A is not self.A) or (u.version != self.version + 1): # new (or refit) model, or missed fits, score all nodes
+            self.A = u.A
+            self.scores = u.variance()
+            self.sums = u.A.sum(axis=1)
+            self.drift = np.zeros(self.scores.size)
+            self._rebuild()
+        else:
+            rows, change = u.last_change
+            np.add.at(self.drift, rows, change)
+            rows = np.unique(rows)
+            stale = rows[2.*self.drift[rows] > self.tol*np.maximum(self.sums[rows] - self.drift[rows], 0.)]
+            self.scores[stale] = u.variance(stale)
+            self.sums[stale] = u.A[stale].sum(axis=1)
+            self.drift[stale] = 0.
+            if len(self.heap) + stale.size > 4*self.scores.size: # mostly outdated entries
+                self._rebuild()
+            else:
+                for i in stale:
+                    heapq.heappush(self.heap, (-self.scores[i], i))
+        self.version = u.version
+
+    def _rebuild(self):
+        self.heap = list(zip(-self.scores, range(self.scores.size)))
+        heapq.heapify(self.heap)
+
+    def compute(self, u, candidate_ind):
+        self._refresh(u)
+        return self.scores[candidate_ind]
+
+    def update(self, query_ind, query_labels):
+        if self.is_candidate is not None:
+            query_ind = np.unique(query_ind)
+            self.num_candidates -= np.count_nonzero(self.is_candidate[query_ind])
+            self.is_candidate[query_ind] = False
+
+    def select(self, u, candidate_ind, batch_size=1):
+        '''
+        The batch_size candidates of largest variance, popped off the heap
+        '''
+        self._refresh(u)
+        if (self.is_candidate is None) or (candidate_ind.size != self.num_candidates): # new candidate set
+            self.is_candidate = np.zeros(self.scores.size, dtype=bool)
+            self.is_candidate[candidate_ind] = True
+            self.num_candidates = candidate_ind.size
+            self._rebuild() # nodes dropped from the heap may be candidates again
+        
+        query_ind = []
+        while (len(query_ind) < batch_size) and (len(self.heap) > 0):
+            score, i = heapq.heappop(self.heap)
+            if (-score != self.scores[i]) or not self.is_candidate[i] or (i in query_ind): # outdated, or not a candidate
+                continue
+            query_ind.append(i)
+        for i in query_ind: # back on the heap until they are labeled (see update)
+            heapq.heappush(self.heap, (-self.scores[i], i))
+        return np.array(query_ind, dtype=int)
+
+class dirichlet_var_batch(dirichlet_var):
+    '''
+    Dirichlet Learning Variance, with greedy lookahead for batches.
+
+    Picks a batch one point at a time among the pool_factor*batch_size candidates of largest variance. After
+    each pick its propagation is added to A under its most likely class (a fantasized label) before rescoring,
+    so later picks avoid the regions earlier picks will settle. Only the propagation of each pick is solved for,
+    by dirichlet_model.propagation (see dirichlet.dirichlet_learning), which keeps it (up to dirichlet.LOOKAHEAD_CACHE
+    columns) for the next fit, where the batch is labeled. A batch thus costs batch_size - 1 single column solves 
+    here and one more in the fit, the batch_size columns labeling it needs anyway, however large the pool.
+    '''
+    def __init__(self, dirichlet_model, pool_factor=4):
+        self.model = dirichlet_model
+        self.pool_factor = pool_factor
+
+    def select(self, u, candidate_ind, batch_size=1):
+        '''
+        Greedy lookahead batch of batch_size candidates (the candidate of largest variance if batch_size = 1)
+        '''
+        vals = self.compute(u, candidate_ind)
+        if batch_size == 1:
+            return candidate_ind[[np.argmax(vals)]]
+        pool = candidate_ind[np.argsort(-vals)[:self.pool_factor*batch_size]]
+        A = self.model.A[pool].astype(np.float64) # only the pool rows are rescored
+        
+        chosen = []
+        for _ in range(min(batch_size, pool.size)):
+            u = A / A.sum(axis=1)[:,np.newaxis]
+            vals = posterior_variance(u)
+            vals[chosen] = -np.inf
+            j = np.argmax(vals)
+            chosen.append(j)
+            if len(chosen) < batch_size: # fantasized label of pool[j], its most likely class
+                A[:,np.argmax(u[j])] += self.model.propagation(pool[[j]])[pool,0]
+        return pool[chosen]
+
+class dirichlet_varprop(acquisition_function):
+    r'''
     Dirichlet Learning Variance, with percentile sampling, not max.
-    
-    CURRENTLY ONLY IMPLEMENTED FOR SEQUENTIAL, NOT BATCH
+
+    Returns the tempered variances perturbed with Gumbel noise, so that the maximizer is a sample from
+    p(x) \propto e^{var(x)/T} and the batch_size largest values are batch_size distinct samples without 
+    replacement (Gumbel-top-k), in one vectorized pass. select returns the samples directly in O(n): a single 
+    sample by inverse transform of the max-shifted weights, a batch by argpartition instead of the sort of the
+    'max' policy of graphlearning's active_learner (see bench_varprop.py).
     '''
     def __init__(self, seed=42):
         self.K = 10
@@ -26,25 +147,70 @@ class dirichlet_varprop(acquisition_function):
     def set_K(self, K):
         print(f"Setting K = {K} for betavarprop")
         self.K = K
-        
-    def compute(self, u, candidate_ind):
-        a0 = u.sum(axis=1)
-        a = (u * u).sum(axis=1)
-        vals = ((1. - a/(a0**2.))/(1. + a0))[candidate_ind]
-        
-        # scaling for p(x) \propto e^{x/T}, where T is scales as the values change. Ensures no numerical overflow occurs
+
+    def _variances(self, u, candidate_ind):
+        return posterior_variance(u[candidate_ind])
+
+    def _temperature(self, vals):
+        # scaling for p(x) \propto e^{x/T}, where T is scales as the values change. Ensures no numerical overflow occurs.
+        # The percentile (linear interpolation, as np.percentile) is read off two order statistics in linear time
         M = vals.max()
-        T0 = M - np.percentile(vals, 100*(1. - 1./self.K))
+        pos = (vals.size - 1) * (1. - 1./self.K)
+        k = int(np.floor(pos))
+        k1 = min(k + 1, vals.size - 1)
+        part = np.partition(vals, [k, k1])
+        T0 = M - (part[k] + (pos - k)*(part[k1] - part[k]))
         eps = M / (self.log_Eps_tilde - np.log(vals.size))
-        T = max(eps, min(1.0,T0))
-        p = np.exp(vals/T)
+        return max(eps, min(1.0,T0))
         
-        # return values so that this k_choice will be the maximizer
-        k_choice = self.rand_state.choice(np.arange(candidate_ind.size), p=p/p.sum())
-        acq_vals = np.zeros_like(candidate_ind)
-        acq_vals[k_choice] = 1.
+    def compute(self, u, candidate_ind):
+        vals = self._variances(u, candidate_ind)
+        T = self._temperature(vals)
+        
+        # Gumbel-max trick in log space, the top values are samples from p without replacement
+        keys = self.rand_state.gumbel(size=vals.size)
+        keys += vals / T
+        return keys
+
+    def select(self, u, candidate_ind, batch_size=1):
+        '''
+        batch_size distinct samples from p, in O(n)
+        '''
+        if batch_size > 1:
+            keys = self.compute(u, candidate_ind)
+            top = np.argpartition(-keys, batch_size - 1)[:batch_size]
+            return candidate_ind[top[np.argsort(-keys[top])]]
         
-        return acq_vals
+        vals = self._variances(u, candidate_ind)
+        T = self._temperature(vals)
+        cdf = np.cumsum(np.exp((vals - vals.max())/T)) # weights shifted in log space, so none overflow
+        k = np.searchsorted(cdf, self.rand_state.uniform()*cdf[-1], side='right')
+        return candidate_ind[[min(k, cdf.size - 1)]]
+
+class var_opt_full(acquisition_function):
+    '''
+    VOpt with the full covariance C = (L + delta I)^{-1}, the values of gl.active_learning.var_opt on that C, 
+    computed from a matrix-free solvers.covariance_operator so that C (n x n) is never formed. On large graphs the 
+    prior quantities are estimated from the eigenvectors evecs (see solvers.covariance_operator).
+    '''
+    def __init__(self, graph, delta=0.001, gamma2=0.1**2., normalization='combinatorial', cache_dir=None, evecs=None):
+        self.cov = covariance_operator(graph, delta=delta, gamma2=gamma2, normalization=normalization, cache_dir=cache_dir,
+                                       evecs=evecs)
+
+    def compute(self, u, candidate_ind):
+        return self.cov.column_norms2(candidate_ind) / (self.cov.gamma2 + self.cov.diagonal(candidate_ind))
+
+    def update(self, query_ind, query_labels):
+        for k in query_ind:
+            self.cov.condition(k)
+
+class sigma_opt_full(var_opt_full):
+    '''
+    SigmaOpt with the full covariance C = (L + delta I)^{-1}, the values of gl.active_learning.sigma_opt on that C,
+    computed from a matrix-free solvers.covariance_operator so that C (n x n) is never formed.
+    '''
+    def compute(self, u, candidate_ind):
+        return self.cov.column_sums(candidate_ind)**2. / (self.cov.gamma2 + self.cov.diagonal(candidate_ind))
 
 class random(acquisition_function):
     '''
@@ -0,0 +1,44 @@
+import numpy as np
+import graphlearning as gl
+import pandas as pd
+import time
+from argparse import ArgumentParser
+from knn import knnsearch, knn_recall
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark approximate knn search backends against exact knn: construction time and recall")
+    parser.add_argument("--datasets", type=str, nargs="+", default=["mnistsmall:vae", "fashionmnistsmall:vae", "paviasub:hsi"],
+                        help="dataset:metric pairs of datasets loadable with gl.datasets.load")
+    parser.add_argument("--knn", type=int, default=20)
+    parser.add_argument("--recall", type=float, nargs="+", default=[0.9, 0.95, 0.99], help="recall targets of the annoy backend")
+    parser.add_argument("--numcores", type=int, default=-1)
+    parser.add_argument("--out", type=str, default=None, help="optional csv file for the results")
+    args = parser.parse_args()
+
+    rows = []
+    for name in args.datasets:
+        dataset, metric = name.split(":")
+        X, _ = gl.datasets.load(dataset, metric=metric)
+        similarity = "angular" if metric == "hsi" else "euclidean" # as in utils.load_graph
+
+        start = time.time()
+        exact_ind, _ = knnsearch(X, args.knn, method='exact', similarity=similarity, n_jobs=args.numcores)
+        exact_time = time.time() - start
+        rows.append({"dataset": dataset, "n": X.shape[0], "method": "exact", "time (s)": exact_time, "recall": 1.})
+
+        start = time.time()
+        knn_ind, _ = gl.weightmatrix.knnsearch(X, args.knn, method='annoy', similarity=similarity)
+        rows.append({"dataset": dataset, "n": X.shape[0], "method": "graphlearning annoy", "time (s)": time.time() - start,
+                     "recall": knn_recall(knn_ind, exact_ind)})
+
+        for recall in args.recall:
+            start = time.time()
+            knn_ind, _ = knnsearch(X, args.knn, method='annoy', similarity=similarity, recall=recall, n_jobs=args.numcores)
+            rows.append({"dataset": dataset, "n": X.shape[0], "method": f"annoy, recall target {recall}",
+                         "time (s)": time.time() - start, "recall": knn_recall(knn_ind, exact_ind)})
+
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
+    if args.out is not None:
+        df.to_csv(args.out, index=None)
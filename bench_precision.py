@@ -0,0 +1,79 @@
+import numpy as np
+import graphlearning as gl
+import pandas as pd
+import tracemalloc
+import time
+from argparse import ArgumentParser
+from utils import load_graph
+from dirichlet import dirichlet_learning
+
+
+def run(G, labels, trainset, tau, solver, dtype, label_seq, batch):
+    # fit on growing labeled sets, as in an active learning run, and return the total time and final model
+    model = dirichlet_learning(G, tau=tau, solver=solver, dtype=dtype)
+    start = time.time()
+    for j in range(batch, label_seq.size + 1, batch):
+        model.fit(label_seq[:j], labels[label_seq[:j]])
+    elapsed = time.time() - start
+    return model, elapsed
+
+
+def model_bytes(model):
+    nbytes = model.A.nbytes + model.A_err.nbytes
+    for col, c in (model.props or {}).values():
+        nbytes += col.data.nbytes if hasattr(col, 'indices') else col.nbytes
+    return nbytes
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark float32 against float64 Dirichlet Learning: memory, wall time and accuracy")
+    parser.add_argument("--datasets", type=str, nargs="+", default=["mnistsmall:vae", "fashionmnistsmall:vae", "paviasub:hsi"],
+                        help="dataset:metric pairs of bundled datasets in data/")
+    parser.add_argument("--tau", type=float, nargs="+", default=[0.1, 0.0001])
+    parser.add_argument("--solver", type=str, default="cg")
+    parser.add_argument("--numlabels", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=str, default=None, help="optional csv file for the results")
+    args = parser.parse_args()
+
+    rows = []
+    for name in args.datasets:
+        dataset, metric = name.split(":")
+        G, labels, trainset, normalization = load_graph(dataset, metric, numeigs=None)
+        if trainset is None:
+            trainset = np.arange(G.num_nodes)
+
+        # one initially labeled point per class (as in test_al_gl.py), then random labels from the trainset
+        init = gl.trainsets.generate(labels, rate=1, seed=args.seed)
+        rest = np.random.RandomState(args.seed).permutation(np.setdiff1d(trainset, init))[:args.numlabels - init.size]
+        label_seq = np.concatenate((init, rest))
+
+        for tau in args.tau:
+            results = {}
+            for dtype in [np.float64, np.float32]:
+                model, elapsed = run(G, labels, trainset, tau, args.solver, dtype, label_seq, args.batch)
+
+                # peak memory (numpy allocations) of a second, traced run
+                tracemalloc.start()
+                run(G, labels, trainset, tau, args.solver, dtype, label_seq, args.batch)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+                # accuracy on the unlabeled nodes of the trainset
+                eval_ind = np.setdiff1d(trainset, model.train_ind)
+                acc = 100*np.mean(model.predict()[eval_ind] == labels[eval_ind])
+                results[np.dtype(dtype).name] = (model, elapsed, peak, acc)
+                rows.append({"dataset": dataset, "tau": tau, "dtype": np.dtype(dtype).name, "time (s)": elapsed,
+                             "iterations": sum(model.prop_iters), "model (MB)": model_bytes(model)/2**20,
+                             "peak (MB)": peak/2**20, "accuracy": acc})
+
+            u64, u32 = results["float64"][0].A, results["float32"][0].A
+            u64, u32 = u64 / u64.sum(axis=1)[:,np.newaxis], u32 / u32.sum(axis=1)[:,np.newaxis]
+            rows[-1]["max |u64 - u32|"] = np.abs(u64 - u32).max()
+            rows[-1]["accuracy delta"] = results["float32"][3] - results["float64"][3]
+
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
+    if args.out is not None:
+        df.to_csv(args.out, index=None)
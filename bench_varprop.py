@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import time
+from argparse import ArgumentParser
+from dirichlet import dirichlet_posterior, posterior_variance
+from acquisitions import dirichlet_varprop
+
+
+def original_select(u, candidate_ind, K=10, log_Eps_tilde=np.log(1e150), rand_state=np.random):
+    # the original dirichlet_varprop: variances of all nodes, full percentile, exp and a weighted choice
+    vals = posterior_variance(np.asarray(u))[candidate_ind]
+    M = vals.max()
+    T0 = M - np.percentile(vals, 100*(1. - 1./K))
+    eps = M / (log_Eps_tilde - np.log(vals.size))
+    T = max(eps, min(1.0,T0))
+    p = np.exp(vals/T)
+    return candidate_ind[[rand_state.choice(np.arange(candidate_ind.size), p=p/p.sum())]]
+
+
+def sort_select(acq, u, candidate_ind, batch_size):
+    # compute followed by the 'max' policy of graphlearning's active_learner
+    return candidate_ind[(-acq.compute(u, candidate_ind)).argsort()[:batch_size]]
+
+
+def best_time(f, reps):
+    times = []
+    for _ in range(reps):
+        start = time.time()
+        f()
+        times.append(time.time() - start)
+    return min(times)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark the selection path of dirichlet_varprop on synthetic posteriors")
+    parser.add_argument("--n", type=int, nargs="+", default=[10**5, 10**6])
+    parser.add_argument("--nc", type=int, default=10)
+    parser.add_argument("--batchsize", type=int, nargs="+", default=[1, 10])
+    parser.add_argument("--reps", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=str, default=None, help="optional csv file for the results")
+    args = parser.parse_args()
+
+    rows = []
+    for n in args.n:
+        rand_state = np.random.RandomState(args.seed)
+        A = 1. + rand_state.gamma(0.5, size=(n, args.nc)) # pseudo-counts of a posterior with a few labels
+        u = dirichlet_posterior(A)
+        candidate_ind = np.sort(rand_state.choice(n, n - n//100, replace=False))
+        for batch_size in args.batchsize:
+            acq = dirichlet_varprop(seed=args.seed)
+            times = {"select": best_time(lambda: acq.select(u, candidate_ind, batch_size), args.reps),
+                     "compute + argsort": best_time(lambda: sort_select(acq, u, candidate_ind, batch_size), args.reps)}
+            if batch_size == 1: # the original only samples one point
+                times["original"] = best_time(lambda: original_select(u, candidate_ind, rand_state=rand_state), args.reps)
+            for method, t in times.items():
+                rows.append({"n": n, "batch size": batch_size, "method": method, "time (s)": t,
+                             "speedup of select": t / times["select"]})
+
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
+    if args.out is not None:
+        df.to_csv(args.out, index=None)
@@ -0,0 +1,263 @@
+import os
+import hashlib
+import weakref
+import numpy as np
+import scipy.sparse as sparse
+import graphlearning as gl
+
+
+# Default location of on-disk caches shared across runs, seeds and processes
+CACHE_DIR = os.path.join("data", "cache")
+
+_graph_hashes = weakref.WeakKeyDictionary()
+
+
+def graph_hash(graph):
+    '''
+    Content hash of a graph's weight matrix, computed once per graph object.
+    '''
+    if graph not in _graph_hashes:
+        W = graph.weight_matrix.tocsr()
+        h = hashlib.sha1()
+        h.update(np.asarray(W.indptr, dtype=np.int64).tobytes())
+        h.update(np.asarray(W.indices, dtype=np.int64).tobytes())
+        h.update(np.asarray(W.data, dtype=np.float64).tobytes())
+        _graph_hashes[graph] = h.hexdigest()[:16]
+    return _graph_hashes[graph]
+
+
+def array_hash(arr):
+    '''
+    Short content hash of an integer array (e.g., a set of node indices)
+    '''
+    return hashlib.sha1(np.asarray(arr, dtype=np.int64).tobytes()).hexdigest()[:8]
+
+
+def load_array(fname, mmap_mode=None):
+    '''
+    Load a cached .npy array, or return None if it is not (or not yet completely) on disk.
+    '''
+    try:
+        return np.load(fname, mmap_mode=mmap_mode)
+    except (FileNotFoundError, ValueError, EOFError):
+        return None
+
+
+def save_array(fname, arr):
+    '''
+    Save an array to a .npy file atomically, so concurrent readers never see a partially written file.
+    '''
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp_fname = f"{fname}.{os.getpid()}.tmp"
+    with open(tmp_fname, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp_fname, fname)
+
+
+# Default size cap of each propagation store
+PROP_STORE_MAX_BYTES = 4 * 2**30
+
+# Columns saved by a process between scans of a propagation store, which pick up the columns other processes saved
+PROP_STORE_SCAN_EVERY = 1024
+
+# Fraction of the size cap a propagation store is evicted down to, so evictions (and their scans) are rare
+PROP_STORE_EVICT_TO = 0.9
+
+
+class prop_store:
+    """Propagation Store
+    ===================
+
+    On-disk store of Poisson propagation columns for one (graph, normalization, tau, dtype), one .npy file per node
+    with the tolerance it was solved to, shared across runs and processes. The least recently used columns are 
+    evicted once the store exceeds max_bytes.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Root cache directory (see CACHE_DIR).
+    graph : graphlearning graph object
+        Graph the propagations are computed on.
+    tau : float
+        Diagonal shift of the graph Laplacian.
+    normalization : str, default='combinatorial'
+        Normalization of the graph Laplacian.
+    max_bytes : int, default=PROP_STORE_MAX_BYTES
+        Size cap of the store.
+    dtype : numpy dtype, default=np.float64
+        Floating point type of the stored columns.
+    """
+    def __init__(self, cache_dir, graph, tau, normalization='combinatorial', max_bytes=PROP_STORE_MAX_BYTES, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        name = f"{graph_hash(graph)}_{normalization}_{tau}"
+        if self.dtype != np.float64:
+            name += f"_{self.dtype.name}"
+        self.dir = os.path.join(cache_dir, "props", name)
+        self.max_bytes = max_bytes
+        self.nbytes = None # tracked size of the store, None until the first scan
+        self.unscanned = 0 # columns saved since the last scan
+
+    def _fname(self, i):
+        return os.path.join(self.dir, f"{i}.npy")
+
+    def load(self, inds, tol, out):
+        '''
+        Fill the columns of out for the nodes in inds found in the store solved to at most tol (one value per
+        node). Returns a boolean mask of the nodes found.
+        '''
+        found = np.zeros(inds.size, dtype=bool)
+        for j, i in enumerate(inds):
+            col = load_array(self._fname(i), mmap_mode='r')
+            if col is None or col.size != out.shape[0] + 1 or col[-1] > col.dtype.type(tol[j]):
+                continue
+            out[:,j] = col[:-1]
+            found[j] = True
+            try:
+                os.utime(self._fname(i)) # mark as recently used
+            except FileNotFoundError:
+                pass
+        return found
+
+    def save(self, inds, props, tol):
+        '''
+        Add the propagation columns props of the nodes in inds, solved to tolerance tol (one value per node).
+        '''
+        for j, i in enumerate(inds):
+            col = np.append(props[:,j], tol[j]).astype(self.dtype)
+            save_array(self._fname(i), col)
+            if self.nbytes is not None:
+                self.nbytes += col.nbytes + 128 # .npy header, overestimates overwritten columns
+        self.unscanned += len(inds)
+        if (self.nbytes is None) or (self.nbytes > self.max_bytes) or (self.unscanned >= PROP_STORE_SCAN_EVERY):
+            self._evict()
+
+    def _evict(self):
+        # scan the store for its size, and evict the least recently used columns if it exceeds max_bytes
+        files = []
+        for entry in os.scandir(self.dir):
+            if not entry.name.endswith(".npy"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        if total > self.max_bytes:
+            for _, size, path in sorted(files):
+                if total <= PROP_STORE_EVICT_TO*self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        self.nbytes = total
+        self.unscanned = 0
+
+
+# Version of the on-disk layout of eigendata stores, part of each store's directory name
+EIG_STORE_VERSION = 1
+
+
+class eig_store:
+    """Eigendata Store
+    ===================
+
+    On-disk store of the lowest eigenpairs of one graph Laplacian, keyed by graph hash, normalization and eigensolver
+    method. Eigenvectors are stored column-major, so the first k of them are read as a slice of the memory map.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Root cache directory (see CACHE_DIR).
+    graph : graphlearning graph object
+        Graph the eigendata are computed on.
+    normalization : str
+        Normalization of the graph Laplacian.
+    method : str
+        Eigensolver method of graph.eigen_decomp ('exact' or 'lowrank').
+    """
+    def __init__(self, cache_dir, graph, normalization, method):
+        self.dir = os.path.join(cache_dir, "eig", f"{graph_hash(graph)}_{normalization}_{method}_v{EIG_STORE_VERSION}")
+
+    def load(self, k=None, mmap_mode='r'):
+        '''
+        The first k stored eigenvalues and eigenvectors (all if k is None), or (None, None) if fewer are stored.
+        '''
+        evals = load_array(os.path.join(self.dir, "evals.npy"))
+        evecs = load_array(os.path.join(self.dir, "evecs.npy"), mmap_mode=mmap_mode)
+        if evals is None or evecs is None or evecs.shape[1] < evals.size:
+            return None, None
+        k = evals.size if k is None else k
+        if evals.size < k:
+            return None, None
+        return evals[:k], evecs[:,:k]
+
+    def save(self, evals, evecs):
+        '''
+        Store eigenvalues and eigenvectors (as columns), replacing any smaller stored basis.
+        '''
+        save_array(os.path.join(self.dir, "evecs.npy"), np.asfortranarray(evecs))
+        save_array(os.path.join(self.dir, "evals.npy"), np.asarray(evals))
+
+
+# Arrays gl.graph derives from the weight matrix for its C code (row-sorted COO coordinates and row offsets)
+GRAPH_CCODE_ARRAYS = ["I", "J", "V", "K", "Vinv"]
+
+
+class graph_store:
+    """Graph Store
+    ===================
+
+    On-disk store of a graph's CSR weight matrix, its C code arrays (GRAPH_CCODE_ARRAYS) and its content hash, as
+    memory-mappable .npy files. Loaded graphs are file-backed, so joblib passes them to workers by reference. The
+    eigendata live in eig_store.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store (e.g., data/cache/graphs/mnist_20).
+    """
+    def __init__(self, path):
+        self.dir = path
+
+    def _fname(self, name):
+        return os.path.join(self.dir, f"{name}.npy")
+
+    def load(self, mmap_mode='c'):
+        '''
+        The stored graph, or None if there is none. The arrays are mapped copy-on-write by default, so in-place
+        changes stay private to the process.
+        '''
+        ghash = load_array(self._fname("hash"))
+        arrays = [load_array(self._fname(name), mmap_mode=mmap_mode) for name in ["data", "indices", "indptr"]]
+        if ghash is None or any(arr is None for arr in arrays):
+            return None
+        n = arrays[2].size - 1
+        G = gl.graph(sparse.csr_matrix(tuple(arrays), shape=(n, n)))
+        _graph_hashes[G] = str(ghash)
+        for name in GRAPH_CCODE_ARRAYS:
+            arr = load_array(self._fname(name), mmap_mode=mmap_mode)
+            if arr is not None and arr.shape == getattr(G, name).shape: # stores of earlier versions lack them
+                setattr(G, name, arr)
+        return G
+
+    def save(self, graph):
+        '''
+        Store the weight matrix of graph, unless the stored one has the same content hash. Returns whether it was written.
+        Missing C code arrays are added to a store with the same hash.
+        '''
+        ghash = load_array(self._fname("hash"))
+        if ghash is not None and str(ghash) == graph_hash(graph):
+            for name in GRAPH_CCODE_ARRAYS:
+                if not os.path.exists(self._fname(name)):
+                    save_array(self._fname(name), getattr(graph, name))
+            return False
+        W = graph.weight_matrix.tocsr()
+        for name in ["data", "indices", "indptr"]:
+            save_array(self._fname(name), getattr(W, name))
+        for name in GRAPH_CCODE_ARRAYS:
+            save_array(self._fname(name), getattr(graph, name))
+        save_array(self._fname("hash"), np.array(graph_hash(graph))) # last, so a complete store is never mismatched
+        return True
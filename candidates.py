@@ -0,0 +1,147 @@
+import numpy as np
+from scipy.sparse import csgraph
+
+
+class candidate_index:
+    """Candidate Index
+    ===================
+
+    Coarse-to-fine pruning of the candidates of an acquisition function. Nodes are clustered by hop distance to
+    random centers, prune scores reps candidates per cluster and keeps all candidates of the refine best clusters.
+
+    Parameters
+    ----------
+    graph : graphlearning graph object
+        Graph of the active learning problem.
+    num_clusters : int
+        Number of clusters (e.g., on the order of sqrt(n)).
+    reps : int, default=4
+        Number of representatives scored per cluster.
+    refine : int, default=8
+        Number of clusters whose candidates are all scored.
+    seed : int, default=0
+        Seed for the cluster centers.
+    """
+    def __init__(self, graph, num_clusters, reps=4, refine=8, seed=0):
+        self.reps = reps
+        self.refine = refine
+        n = graph.num_nodes
+        W = graph.weight_matrix.tocsr()
+        rand_state = np.random.RandomState(seed)
+
+        # nearest center of each node, with extra centers in components no center reaches
+        centers = rand_state.choice(n, min(num_clusters, n), replace=False)
+        while True:
+            dist, _, sources = csgraph.dijkstra(W, directed=False, indices=centers, unweighted=True, min_only=True,
+                                                return_predecessors=True)
+            unreached = np.where(sources < 0)[0]
+            if unreached.size == 0:
+                break
+            centers = np.append(centers, rand_state.choice(unreached))
+        self.centers = centers
+        position = np.zeros(n, dtype=int)
+        position[centers] = np.arange(centers.size)
+        self.cluster = position[sources] # position of each node's center in centers
+
+        # nodes grouped by cluster, nearest the center first (ties in random order)
+        self.order = np.lexsort((rand_state.rand(n), dist, self.cluster))
+
+    @property
+    def num_clusters(self):
+        return self.centers.size
+
+    def representatives(self, candidate_ind):
+        '''
+        The (at most) reps candidates of each cluster nearest its center
+        '''
+        is_candidate = np.zeros(self.cluster.size, dtype=bool)
+        is_candidate[candidate_ind] = True
+        grouped = self.order[is_candidate[self.order]]
+        clusters = self.cluster[grouped]
+        rank = np.arange(grouped.size) - np.searchsorted(clusters, clusters) # position within its cluster
+        return grouped[rank < self.reps]
+
+    def prune(self, acq_function, u, candidate_ind):
+        '''
+        Candidates of the refine clusters whose representatives have the largest acquisition values (as computed
+        by acq_function.compute on u), in the order of candidate_ind. Acquisitions with internal randomness (e.g.,
+        dirichlet_varprop) draw their random values for the representatives too.
+        '''
+        reps = self.representatives(candidate_ind)
+        if reps.size >= candidate_ind.size:
+            return candidate_ind
+        scores = np.full(self.num_clusters, -np.inf)
+        np.maximum.at(scores, self.cluster[reps], acq_function.compute(u, reps))
+        top = np.argsort(-scores)[:self.refine]
+        keep = np.zeros(self.num_clusters, dtype=bool)
+        keep[top[scores[top] > -np.inf]] = True
+        return candidate_ind[keep[self.cluster[candidate_ind]]]
+
+    def recall(self, acq_function, u, candidate_ind, k=1):
+        '''
+        Fraction of the k candidates of largest acquisition value that survive prune, to tune reps and refine
+        '''
+        top = candidate_ind[np.argsort(-acq_function.compute(u, candidate_ind))[:k]]
+        return np.isin(top, self.prune(acq_function, u, candidate_ind)).mean()
+
+    def value_ratio(self, acq_function, u, candidate_ind):
+        '''
+        Largest acquisition value among the pruned candidates relative to the largest overall (for nonnegative values,
+        e.g., variances). Near 1 even at low recall when the acquisition function is flat around its maximum.
+        '''
+        vals = acq_function.compute(u, candidate_ind)
+        keep = np.isin(candidate_ind, self.prune(acq_function, u, candidate_ind))
+        return vals[keep].max() / vals.max()
+
+
+class candidate_pool:
+    """Candidate Pool
+    ===================
+
+    Unlabeled nodes of a training set, removed in O(1) by swapping with the last candidate, so candidates (a
+    read-only view) are not sorted.
+
+    Parameters
+    ----------
+    num_nodes : int
+        Number of nodes of the graph.
+    candidate_ind : numpy array, default=None
+        Training set the candidates are drawn from (all nodes if None).
+    labeled_ind : numpy array, default=None
+        Labeled nodes, removed from the candidates.
+    """
+    def __init__(self, num_nodes, candidate_ind=None, labeled_ind=None):
+        self.pool = np.arange(num_nodes) if candidate_ind is None else np.array(candidate_ind, dtype=int)
+        self.position = np.full(num_nodes, -1) # position of each node in pool, -1 if not a candidate
+        self.position[self.pool] = np.arange(self.pool.size)
+        self.size = self.pool.size
+        if labeled_ind is not None:
+            self.remove(labeled_ind)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def candidates(self):
+        view = self.pool[:self.size]
+        view.flags.writeable = False
+        return view
+
+    def sorted(self):
+        '''
+        The candidates in increasing order, in O(num_nodes), e.g., to draw from them as from np.arange-based candidates
+        '''
+        return np.flatnonzero(self.position >= 0)
+
+    def remove(self, inds):
+        '''
+        Remove the nodes in inds from the candidates (nodes that are not candidates are ignored)
+        '''
+        for i in np.atleast_1d(inds):
+            p = self.position[i]
+            if p < 0:
+                continue
+            last = self.pool[self.size - 1]
+            self.pool[p], self.position[last] = last, p
+            self.pool[self.size - 1], self.position[i] = i, -1
+            self.size -= 1
@@ -1,10 +1,110 @@
 import numpy as np 
 import graphlearning as gl
 import scipy.sparse as sparse
+import os
+from collections import OrderedDict
+from solvers import get_solver, multishift_cg_solver
+from cache import graph_hash, array_hash, load_array, save_array, prop_store
+
+
+# Resolution to which the posterior mean u = A / A.sum(axis=1) (and so dirichlet_var) needs to be accurate
+POSTERIOR_RESOLUTION = 1e-3
+
+# Number of propagation columns solved and held in memory at once in _fit
+PROP_CHUNK = 64
+
+# Number of propagation columns of unlabeled nodes kept by dirichlet_learning.propagation (e.g., for lookahead)
+LOOKAHEAD_CACHE = 64
+
+
+def posterior_variance(u):
+    '''
+    Variance of the Dirichlet posteriors at the rows of the mean estimator u (classes along the last axis)
+    '''
+    a0 = u.sum(axis=-1)
+    a = (u * u).sum(axis=-1)
+    return (1. - a/(a0**2.))/(1. + a0)
+
+
+class dirichlet_posterior:
+    """Dirichlet Posterior
+    ===================
+
+    Lazy view of the Dirichlet posterior with pseudo-counts A (n x nc), returned by dirichlet_learning.fit in
+    place of the mean estimator u = A / A.sum(axis=1). The mean estimator, its argmax and the variance are only 
+    computed for the rows asked for (e.g., the candidate nodes of an acquisition function), so no n x nc array 
+    is allocated per fit. Indexing (u[ind], u[ind, c]) returns rows of the mean estimator, and np.asarray(u)
+    builds the full mean estimator. This is a view: later in-place updates of the model's A are reflected.
+
+    Parameters
+    ----------
+    A : numpy array
+        Pseudo-counts of the posterior.
+    row_change : numpy array (optional), default=None
+        The model's cumulative l1 change of each row of A since A was created (in double precision), which 
+        incremental consumers (see tracker.accuracy_tracker) compare with their own earlier copy.
+    last_change : tuple of numpy arrays (optional), default=None
+        Rows of A changed by the fit that returned this posterior and their l1 changes (rows may repeat), only 
+        for truncated propagations, None if any row may have changed (see acquisitions.dirichlet_var_index).
+    version : int, default=0
+        Number of fits of the model so far, so consumers can tell whether they saw every last_change.
+    """
+    def __init__(self, A, row_change=None, last_change=None, version=0):
+        self.A = A
+        self.row_change = row_change
+        self.last_change = last_change
+        self.version = version
+
+    @property
+    def shape(self):
+        return self.A.shape
+
+    @property
+    def dtype(self):
+        return self.A.dtype
+
+    @property
+    def ndim(self):
+        return 2
+
+    def __len__(self):
+        return self.A.shape[0]
+
+    def _rows(self, ind):
+        return self.A if ind is None else self.A[ind]
+
+    def mean(self, ind=None):
+        '''
+        Mean estimator at the nodes in ind (all nodes if None)
+        '''
+        A = self._rows(ind)
+        return A / A.sum(axis=-1)[...,np.newaxis]
+
+    def argmax(self, ind=None):
+        '''
+        Most likely class at the nodes in ind (all nodes if None), without forming the mean estimator
+        '''
+        return np.argmax(self._rows(ind), axis=-1)
+
+    def variance(self, ind=None):
+        '''
+        Variance of the nodes in ind (all nodes if None), see posterior_variance
+        '''
+        return posterior_variance(self.mean(ind))
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        return self.mean(rows)[...,cols]
+
+    def __array__(self, dtype=None, copy=None):
+        u = self.mean()
+        return u if dtype is None else u.astype(dtype)
 
 
 class dirichlet_learning(gl.ssl.ssl):
-    def __init__(self, W=None, class_priors=None, tau=0.0, epsK=None, seed=42):
+    def __init__(self, W=None, class_priors=None, tau=0.0, epsK=None, seed=42, solver='auto', tol='auto', warm_start=64,
+                 verbose=False, normalization='combinatorial', solver_kwargs=None, sparse_topk=None, sparse_thresh=None,
+                 cache_dir=None, prop_store_bytes=0, keep_props=False, dtype=np.float64):
         """Dirichlet Learning with Epsilon prior
         ===================
 
@@ -19,26 +119,80 @@ class dirichlet_learning(gl.ssl.ssl):
             nodes in each class.
         K : int, default=10
             Number of "known" clusters in the dataset. Parameter for choosing epsilon prior size
+        solver : {'auto','direct','cg','spectral'}, default='auto'
+            Solver for the Poisson propagations (see solvers.get_solver). The solver is built once, on 
+            the first propagation, and reused for the lifetime of the model. 'spectral' approximates the
+            propagations from the eigendata stored in the graph; see propagation_error for its accuracy.
+        tol : float or 'auto', default='auto'
+            Residual tolerance for each propagation with iterative solvers. 'auto' ties the tolerance
+            to POSTERIOR_RESOLUTION of the mean estimator (see _prop_tol).
+        warm_start : int, default=64
+            Number of previously computed propagations kept to warm start iterative solves at the 
+            same nodes (e.g., when refitting from scratch).
+        verbose : bool, default=False
+            Print the number of solver iterations of each propagation call. These are always recorded
+            in self.prop_iters.
+        normalization : str, default='combinatorial'
+            Normalization of the graph Laplacian used in the Poisson propagations. Use 'normalized' to match
+            the eigendata computed by utils.load_graph for the spectral solver.
+        solver_kwargs : dict, default=None
+            Extra keyword arguments for the solver (e.g., k for the spectral solver).
+        sparse_topk : int (optional), default=None
+            If given, keep only the sparse_topk largest entries of each (source-scaled) propagation column.
+        sparse_thresh : float (optional), default=None
+            If given, drop the entries of each source-scaled propagation column below sparse_thresh, so each 
+            label perturbs A by less than sparse_thresh per entry. With either sparse option the propagations 
+            are kept as sparse matrices, and the mass dropped from A is tracked in self.A_err (see 
+            truncation_error).
+        cache_dir : str (optional), default=None
+            Directory in which to persist epsilon prior estimates (and propagation columns, see prop_store_bytes)
+            across runs and processes (see cache.CACHE_DIR).
+        prop_store_bytes : int, default=0
+            Size cap of the on-disk store of propagation columns in cache_dir (see cache.prop_store), 0 to not store
+            propagations. Propagations of the spectral solver are not stored.
+        keep_props : bool, default=False
+            Keep the (scaled) propagation of every label in self.props, so that labels can be removed or 
+            corrected (see remove_label, relabel) without refitting, and for leave_one_out. Costs one column 
+            of length n per label (less with the sparse options), so only enable it where these are used.
+        dtype : numpy dtype, default=np.float64
+            Floating point type of A, the kept propagations and the mean estimator. np.float32 halves their memory,
+            and also runs the conjugate gradient iterations in single precision with iterative refinement in double 
+            precision, so propagations still meet the model's tolerance (see solvers.cg_solver).
         """
         super().__init__(W, class_priors)
         self.tau = tau
         self.train_ind = np.array([])
+        self.train_labels = np.array([])
+        self.keep_props = keep_props
+        self.props = None
+        self.row_change = None
+        self.version = 0
+        self._touched = None
+        self.dtype = np.dtype(dtype)
+        self.seed = seed
         self.rand_state = np.random.RandomState(seed)
+        self.solver_method = solver
+        self.solver_kwargs = solver_kwargs or {}
+        self.solver = None
+        self.normalization = normalization
+        self.sparse_topk = sparse_topk
+        self.sparse_thresh = sparse_thresh
+        self.cache_dir = cache_dir
+        self.prop_store_bytes = prop_store_bytes
+        self.store = None
+        self.tol = tol
+        self.warm_start = warm_start
+        self.verbose = verbose
+        self.prop_iters = []
+        self._warm_props = OrderedDict()
+        self._presolved = OrderedDict()
         
         
         # If have passed K value at this initialization, then can set epsilon prior accordingly
+        # otherwise prior is Beta(1,1,...,1)
+        self.eps = 1.0
         if epsK is not None:
-            # epsilon calculation
-            MULT = 5
-            num_eps_props = epsK * MULT
-            rand_inds = self.rand_state.choice(self.graph.num_nodes, num_eps_props, replace=False)
-            props = self.poisson_prop(rand_inds)
-            props_to_inds = np.max(props, axis=1)
-            epsilons = np.array([np.percentile(props[:,i], 100.*(epsK-1.)/epsK) for i in range(props.shape[1])])
-            self.eps = np.max(epsilons)
-        else:
-            # prior is Beta(1,1,...,1)
-            self.eps = 1.0
+            self.set_eps(epsK)
         
         # Setup accuracy filename
         fname = '_dir' 
@@ -56,54 +210,381 @@ class dirichlet_learning(gl.ssl.ssl):
             MULT = 5
             num_eps_props = K * MULT
             rand_inds = self.rand_state.choice(self.graph.num_nodes, num_eps_props, replace=False)
-            props = self.poisson_prop(rand_inds)
-            props_to_inds = np.max(props, axis=1)
-            epsilons = np.array([np.percentile(props[:,i], 100.*(K-1.)/K) for i in range(props.shape[1])])
-            self.eps = np.max(epsilons)
+            self.eps = self._estimate_eps(rand_inds, K)
             
         if verbose:
             print(f"\tSetting eps = {self.eps} for Dirichlet Learning, tau = {self.tau}")
         return 
+
+    def _estimate_eps(self, rand_inds, K):
+        '''
+        Max over rand_inds of the 100(K-1)/K percentile of their propagations, streamed PROP_CHUNK columns 
+        at a time. Persisted in self.cache_dir keyed by graph, tau, K, seed and the sampled nodes.
+        '''
+        if self.cache_dir is not None:
+            fname = os.path.join(self.cache_dir, "eps", f"{graph_hash(self.graph)}_{self.normalization}_{self.solver_method}"
+                                 f"_{self.tau}_{K}_{self.seed}_{array_hash(rand_inds)}.npy")
+            eps = load_array(fname)
+            if eps is not None:
+                return float(eps)
+
+        eps = 0.
+        for start in range(0, rand_inds.size, PROP_CHUNK):
+            props = self.poisson_prop(rand_inds[start:start+PROP_CHUNK], tol=1e-9) # eps is read off the raw propagations, so solve them tightly
+            eps = max(eps, np.percentile(props, 100.*(K-1.)/K, axis=0).max())
+
+        if self.cache_dir is not None:
+            save_array(fname, np.array(eps))
+        return eps
         
 
     def _fit(self, train_ind, train_labels, all_labels=None):
         # Not currently designed for repeated indices in train_ind
-        if train_ind.size >= self.train_ind.size:
+        n, nc = self.graph.num_nodes, int(train_labels.max()) + 1 # classes 0, ..., nc-1, as graphlearning's one-hot labels
+        # a change of the number of classes (e.g., by relabel or remove_label) changes every column of A, so refit
+        refit = (self.train_ind.size == 0) or (self.A.shape[1] != nc)
+        truncate = (self.sparse_topk is not None) or (self.sparse_thresh is not None)
+        self._touched = [] if truncate else None # rows changed by this fit, see dirichlet_posterior.last_change
+        if self.props is None and not refit:
+            # without kept propagations, removed or changed labels can only be undone by refitting
+            old_labels = np.full(n, -1)
+            old_labels[train_ind] = train_labels
+            refit = np.any(old_labels[self.train_ind] != self.train_labels)
+        if self.props is not None and not refit:
+            # subtract the propagations of labels that were removed or changed, so only new labels are propagated
+            new_labels = dict(zip(train_ind.tolist(), train_labels.tolist()))
+            for i, (col, c) in list(self.props.items()):
+                if new_labels.get(i) == c:
+                    continue
+                self._add_prop(col, c, sign=-1.)
+                if i in new_labels:
+                    self._add_prop(col, new_labels[i])
+                    self.props[i] = (col, new_labels[i])
+                else:
+                    del self.props[i]
+            mask = ~np.isin(train_ind, np.fromiter(self.props.keys(), dtype=int, count=len(self.props)))
+            prop_ind, prop_labels = train_ind[mask], train_labels[mask]
+        elif train_ind.size >= self.train_ind.size and not refit:
             mask = ~np.isin(train_ind, self.train_ind)
             prop_ind = train_ind[np.where(mask)[0]]
             prop_labels = train_labels[np.where(mask)[0]]
-        else: # if give fewer training labels than before, we assume that this is a "new" instantiation
+        else: # if give fewer training labels than before (or the classes changed), we assume that this is a "new" instantiation
             prop_ind, prop_labels = train_ind, train_labels
             mask = np.ones(3, dtype=bool)
         self.train_ind = train_ind
-        n, nc = self.graph.num_nodes, np.unique(train_labels).size
-        
-        P = self.poisson_prop(prop_ind)
-        
-        P /= P[prop_ind,np.arange(prop_ind.size)][np.newaxis,:] # scale by the value at the point sources
+        self.train_labels = train_labels
 
         if mask.all(): # prop_ind == train_ind, so all inds are "new"
-            self.A = self.eps*np.ones((n, nc))  # Dir(1,1,1,...,1) prior on each node
+            self.A = self.eps*np.ones((n, nc), dtype=self.dtype)  # Dir(1,1,1,...,1) prior on each node
+            self.A_err = np.zeros((n, nc), dtype=self.dtype)
+            self.row_change = np.zeros(n) # float64 even for float32 A, consumers take differences
+            self.props = {} if self.keep_props else None
 
-        # Add propagations according to class for the propagation inds (prop_inds)
-        for c in np.unique(prop_labels):
-            self.A[:, c] += np.sum(P[:,np.where(prop_labels == c)[0]], axis=1) # sum propagations together according to class
-        
+        # Add propagations according to class for the propagation inds (prop_inds), a chunk of columns at a time
+        for start in range(0, prop_ind.size, PROP_CHUNK):
+            chunk_ind, chunk_labels = prop_ind[start:start+PROP_CHUNK], prop_labels[start:start+PROP_CHUNK]
+            P = self.poisson_prop(chunk_ind)
+            P /= P[chunk_ind,np.arange(chunk_ind.size)][np.newaxis,:] # scale by the value at the point sources
+            
+            # sums propagations together according to class
+            onehot = np.eye(nc, dtype=self.dtype)[chunk_labels]
+            if truncate:
+                P_sparse = self._truncate(P)
+                self.A_err += P @ onehot - P_sparse @ onehot
+                P = P_sparse
+            self.A += P @ onehot
+            if truncate:
+                np.add.at(self.row_change, P.indices, P.data)
+                self._touched.append((P.indices, P.data))
+            else:
+                self.row_change += P.sum(axis=1)
+
+            if self.props is not None:
+                for j, i in enumerate(chunk_ind):
+                    self.props[i] = (P[:,[j]] if truncate else P[:,j].copy(), chunk_labels[j])
 
-        u = self.A / (self.A.sum(axis=1)[:,np.newaxis]) # mean estimator
-        return u
+        if truncate and self.verbose:
+            err = self.truncation_error()
+            print(f"\tTruncation dropped at most {self.A_err.max():.2e} from any entry of A, mean estimator perturbed by "
+                  f"at most {err.mean():.2e} (mean), {err.max():.2e} (max) in l1")
+
+        self.version += 1
+        last_change = None
+        if self._touched is not None:
+            last_change = (np.concatenate([rows for rows, _ in self._touched] + [np.zeros(0, dtype=int)]),
+                           np.concatenate([change for _, change in self._touched] + [np.zeros(0)]).astype(np.float64))
+        self._touched = None
+        return dirichlet_posterior(self.A, self.row_change, last_change, self.version) # mean estimator, evaluated lazily
+    
+    def predict(self, ignore_class_priors=False, ind=None):
+        '''
+        Predicted labels at the nodes in ind (all nodes if None). Without class priors this is the argmax of 
+        the pseudo-counts A, so the mean estimator is never formed.
+        '''
+        if self.class_priors is not None and not ignore_class_priors:
+            pred = super().predict(ignore_class_priors) # volume constrained labels need the full mean estimator
+            return pred if ind is None else pred[ind]
+        return self.prob.argmax(ind)
     
-    def poisson_prop(self, inds):
-        # Poisson propagation
+    def _add_prop(self, col, c, sign=1.):
+        # add (or subtract) a kept propagation to class c of A. A_err is left alone when subtracting, 
+        # which keeps it a valid (conservative) bound
+        if sparse.issparse(col):
+            self.A[col.indices, c] += sign*col.data
+            np.add.at(self.row_change, col.indices, col.data)
+            if self._touched is not None:
+                self._touched.append((col.indices, col.data))
+        else:
+            self.A[:, c] += sign*col
+            self.row_change += col
+            self._touched = None
+
+    def remove_label(self, ind):
+        '''
+        Remove the label at node ind, subtracting its propagation from A in O(n*nc) without any solves if
+        propagations are kept (keep_props), refitting otherwise. Returns the updated mean estimator, as fit does.
+        '''
+        keep = self.train_ind != ind
+        return self.fit(self.train_ind[keep], self.train_labels[keep])
+
+    def relabel(self, ind, label):
+        '''
+        Correct the label at node ind to label, moving its propagation between classes of A in O(n*nc) without 
+        any solves if propagations are kept (keep_props), refitting otherwise. Returns the updated mean estimator.
+        '''
+        train_labels = self.train_labels.copy()
+        train_labels[self.train_ind == ind] = label
+        return self.fit(self.train_ind, train_labels)
+
+    def leave_one_out(self):
+        '''
+        Leave-one-out predictions: the label each training node would be predicted to have if its own label
+        were removed, from the kept propagations in O(nc) per label. Aligned with self.train_ind.
+        '''
+        if self.props is None:
+            raise ValueError("leave_one_out needs the kept propagations, construct the model with keep_props=True")
+        rows = self.A[self.train_ind].copy()
+        for j, i in enumerate(self.train_ind):
+            col, c = self.props[i]
+            rows[j, c] -= col[i,0] if sparse.issparse(col) else col[i]
+        return np.argmax(rows, axis=1)
+
+    def _truncate(self, P):
+        # keep only the significant entries of each propagation column, as a sparse matrix
+        if self.sparse_thresh is not None:
+            P = np.where(P >= self.sparse_thresh, P, 0.)
+        if self.sparse_topk is not None and self.sparse_topk < P.shape[0]:
+            rows = np.argpartition(-P, self.sparse_topk - 1, axis=0)[:self.sparse_topk]
+            cols = np.broadcast_to(np.arange(P.shape[1]), rows.shape)
+            P_sparse = sparse.csc_matrix((P[rows, cols].ravel(), (rows.ravel(), cols.ravel())), shape=P.shape)
+            P_sparse.eliminate_zeros()
+            return P_sparse
+        return sparse.csc_matrix(P)
+
+    def truncation_error(self):
+        '''
+        Per node bound on the l1 distance between the mean estimator of this (truncated) model and the one
+        with full propagations. Propagations are nonnegative, so A_err is exactly the mass dropped from A,
+        and a row of u moves by at most 2*A_err.sum()/(A.sum() + A_err.sum()) in l1.
+        '''
+        err = self.A_err.sum(axis=1)
+        return 2.*err / (self.A.sum(axis=1) + err)
+
+    def propagation(self, inds):
+        '''
+        Propagations of the nodes in inds scaled by their source values, as they are (or would be) added to A, e.g.
+        for the lookahead of acquisitions.dirichlet_var_batch. Labeled nodes use their kept propagations. The others
+        are solved for in one call and kept (the last LOOKAHEAD_CACHE of them), so looking them up again, or labeling
+        them in the next fit, needs no further solves. Returns a dense n x len(inds) array.
+        '''
+        P = np.zeros((self.graph.num_nodes, inds.size), dtype=self.dtype)
+        todo = []
+        for j, i in enumerate(inds):
+            if self.props is not None and i in self.props:
+                col = self.props[i][0]
+                P[:,j] = col.toarray().ravel() if sparse.issparse(col) else col
+            elif i in self._presolved:
+                P[:,j] = self._presolved[i] / self._presolved[i][i]
+                self._presolved.move_to_end(i)
+            else:
+                todo.append(j)
+        if len(todo) > 0:
+            todo = np.array(todo)
+            Q = self.poisson_prop(inds[todo])
+            for j, i in enumerate(inds[todo]):
+                self._presolved[i] = Q[:,j].copy()
+            while len(self._presolved) > max(LOOKAHEAD_CACHE, inds.size):
+                self._presolved.popitem(last=False)
+            P[:,todo] = Q / Q[inds[todo],np.arange(todo.size)][np.newaxis,:]
+        return P
+
+    def poisson_prop(self, inds, tol=None):
+        # Poisson propagation, tol=None uses the model's tolerance (see _prop_tol)
+        self._init_solver()
+        if tol is None:
+            tol = self._prop_tol(inds)
+        if self.store is None and not self._presolved:
+            return self._solve(inds, tol)
+        
+        # use propagations handed in by fit_tau_family or kept by propagation, or found in the on-disk store, and only solve for the rest
+        if not self.solver.iterative:
+            tol = 0.
+        elif tol is None:
+            tol = self.solver.tol
+        tol = np.broadcast_to(tol, (inds.size,))
+        prop = np.zeros((self.graph.num_nodes, inds.size), dtype=self.dtype)
+        found = np.array([i in self._presolved for i in inds], dtype=bool)
+        for j in np.where(found)[0]:
+            prop[:,j] = self._presolved.pop(inds[j])
+        if self.store is not None and not found.all():
+            missing = np.where(~found)[0]
+            loaded = np.zeros((self.graph.num_nodes, missing.size), dtype=self.dtype)
+            found[missing] = self.store.load(inds[missing], tol[missing], loaded)
+            prop[:,missing] += loaded
+        if not found.all():
+            prop[:,~found] = self._solve(inds[~found], tol[~found])
+            if self.store is not None:
+                self.store.save(inds[~found], prop[:,~found], tol[~found])
+        return prop
+
+    def _init_solver(self):
+        if self.solver is None:
+            self.solver = get_solver(self.graph, tau=self.tau, method=self.solver_method, normalization=self.normalization,
+                                     dtype=self.dtype, **self.solver_kwargs)
+            if self.cache_dir is not None and self.prop_store_bytes > 0 and self.solver_method != 'spectral':
+                self.store = prop_store(self.cache_dir, self.graph, self.tau, normalization=self.normalization, 
+                                        max_bytes=self.prop_store_bytes, dtype=self.dtype)
+
+    def _solve(self, inds, tol):
         n, num_prop = self.graph.num_nodes, inds.size
         F = np.zeros((n, num_prop))
         F[inds,:] = np.eye(num_prop)
         F -= np.mean(F, axis=0)
 
-        L = self.graph.laplacian()
-        if self.tau  > 0.0:
-            L += self.tau*sparse.eye(L.shape[0])
+        prop = self.solver.solve(F, x0=self._warm_start(inds), tol=tol)
+        self.prop_iters.append(self.solver.last_iters)
+        if self.verbose:
+            print(f"\tPropagated {num_prop} labels in {self.solver.last_iters} iterations, tau = {self.tau}")
+        
+        if self.solver.iterative and self.warm_start > 0:
+            for j in range(max(num_prop - self.warm_start, 0), num_prop):
+                self._warm_props[inds[j]] = prop[:,j].copy()
+                self._warm_props.move_to_end(inds[j])
+            while len(self._warm_props) > self.warm_start:
+                self._warm_props.popitem(last=False)
 
-        prop = gl.utils.conjgrad(L, F, tol=1e-9)
         prop -= np.min(prop, axis=0)
         return prop
+    
+    def _warm_start(self, inds):
+        # initial guess from previously computed propagations at the same nodes, if any
+        if not self.solver.iterative or not any(i in self._warm_props for i in inds):
+            return None
+        x0 = np.zeros((self.graph.num_nodes, inds.size))
+        for j, i in enumerate(inds):
+            if i in self._warm_props:
+                x0[:,j] = self._warm_props[i]
+        return x0
+    
+    def _prop_tol(self, inds):
+        '''
+        Residual tolerance for the propagation of each index in inds. A propagation is min-shifted and
+        scaled by its value at the source, which is at least 1/(L + tau I)_ii, so a residual r perturbs 
+        its pseudo-counts by at most 2|r|(L + tau I)_ii/tau. Since every row of A sums to at least eps, the
+        mean estimator (and dirichlet_var) then moves by at most that divided by eps.
+        '''
+        if not isinstance(self.tol, str):
+            return self.tol
+        if not self.solver.iterative or self.tau <= 0.0:
+            return None # no spectral gap to bound the error, use the solver default
+        diag = self.solver.matrix.diagonal()[inds]
+        return np.maximum(POSTERIOR_RESOLUTION*self.eps*self.tau/(2.*diag), 1e-12)
+
+    def propagation_error(self, inds=None, num=10, seed=0):
+        '''
+        Relative 2-norm error of this model's propagations at inds, scaled by their source values as they
+        enter A, against propagations solved to 1e-9 with conjugate gradient. Useful to check approximate
+        solvers (e.g., 'spectral'). If inds is None, num random nodes are used.
+        '''
+        if inds is None:
+            inds = np.random.RandomState(seed).choice(self.graph.num_nodes, num, replace=False)
+        P = self.poisson_prop(inds)
+        P /= P[inds,np.arange(inds.size)][np.newaxis,:]
+
+        n = self.graph.num_nodes
+        F = np.zeros((n, inds.size))
+        F[inds,:] = np.eye(inds.size)
+        F -= np.mean(F, axis=0)
+        exact = get_solver(self.graph, tau=self.tau, method='cg', normalization=self.normalization).solve(F, tol=1e-9)
+        exact -= np.min(exact, axis=0)
+        exact /= exact[inds,np.arange(inds.size)][np.newaxis,:]
+
+        err = np.linalg.norm(P - exact, axis=0) / np.linalg.norm(exact, axis=0)
+        if self.verbose:
+            print(f"\tPropagation error of {type(self.solver).__name__}: mean = {err.mean():.2e}, max = {err.max():.2e}")
+        return err
+
+
+def fit_tau_family(models, train_ind, train_labels):
+    '''
+    Fit several dirichlet_learning models that share a graph and normalization but differ in tau (e.g., 
+    dirichlet0001, ..., dirichlet1000 of utils.get_models) on the same labels, computing the new propagations 
+    of all of them with one multi-shift conjugate gradient solve (see solvers.multishift_cg_solver) instead of 
+    one solve per model. Only models with an iterative solver join the shared solve, the others (e.g., direct or 
+    spectral solvers) are fit on their own. The shared solve uses fewer matrix-vector products (about half those of 
+    separate fits for 4 values of tau), but neither the Jacobi preconditioner nor the block iterations of 
+    solvers.cg_solver, so it is only faster in wall time for larger families (on the order of 8 values of tau), and 
+    slower for the 4 of utils.MODELS. Its iterations are recorded once, in prop_iters of the model of the smallest tau 
+    (the base system of the shared solve), the other models record 0. Returns the list of posteriors (see 
+    dirichlet_posterior).
+    '''
+    if len(set(model.normalization for model in models)) > 1:
+        raise ValueError("fit_tau_family requires all models to use the same Laplacian normalization")
+    if len(set(graph_hash(model.graph) for model in models)) > 1:
+        raise ValueError("fit_tau_family requires all models to share the same graph")
+    for model in models:
+        model._init_solver()
+    family = [model for model in models if model.solver.iterative]
+    
+    # nodes that any of the models will propagate (a superset is fine, unused columns are dropped after fitting)
+    need = []
+    for model in family:
+        if train_ind.size < model.train_ind.size:
+            known = []
+        elif model.props is not None and model.train_ind.size > 0:
+            known = list(model.props.keys())
+        else:
+            known = model.train_ind
+        need.append(train_ind[~np.isin(train_ind, known)])
+    need = np.unique(np.concatenate(need)) if len(need) > 0 else np.array([], dtype=int)
+    
+    if need.size > 0 and len(family) > 1:
+        taus = np.array([model.tau for model in family])
+        solver = multishift_cg_solver(family[0].graph, np.unique(taus), normalization=family[0].normalization)
+        shift = np.searchsorted(solver.taus, taus)
+        base = family[np.argmin(taus)]
+        n = family[0].graph.num_nodes
+        for start in range(0, need.size, PROP_CHUNK):
+            chunk = need[start:start+PROP_CHUNK]
+            tol = np.full((solver.taus.size, chunk.size), np.inf)
+            for model, s in zip(family, shift):
+                model_tol = model._prop_tol(chunk)
+                model_tol = solver.tol if model_tol is None else np.maximum(model_tol, 1e-12)
+                tol[s] = np.minimum(tol[s], model_tol)
+            
+            F = np.zeros((n, chunk.size))
+            F[chunk,:] = np.eye(chunk.size)
+            F -= np.mean(F, axis=0)
+            X = solver.solve(F, tol=tol)
+            X -= np.min(X, axis=1)[:,np.newaxis,:]
+            for model, s in zip(family, shift):
+                model.prop_iters.append(solver.last_iters if model is base else 0)
+                model._presolved.update((i, X[s,:,j]) for j, i in enumerate(chunk))
+                if model.store is not None:
+                    model.store.save(chunk, X[s], tol[s])
+    
+    u = []
+    for model in models:
+        u.append(model.fit(train_ind, train_labels))
+        model._presolved.clear()
+    return u
@@ -0,0 +1,98 @@
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.neighbors import NearestNeighbors
+
+
+def _prepare(X, similarity):
+    # points in the space where neighbors are euclidean nearest, as in gl.weightmatrix.knnsearch
+    X = np.asarray(X, dtype=np.float64)
+    if similarity == 'angular':
+        X = X / np.maximum(np.linalg.norm(X, axis=1), 1e-20)[:,np.newaxis]
+    elif similarity != 'euclidean':
+        raise ValueError(f"Invalid choice of similarity {similarity}, use 'euclidean' or 'angular'")
+    return X
+
+
+def exact_knnsearch(X, k, similarity='euclidean', query_ind=None, n_jobs=-1):
+    '''
+    Exact k nearest neighbors (including the point itself) of the points in query_ind (all if None), by brute force
+    in parallel. Returns knn_ind, knn_dist as gl.weightmatrix.knnsearch.
+    '''
+    Y = _prepare(X, similarity)
+    nn = NearestNeighbors(n_neighbors=k, algorithm='brute', n_jobs=n_jobs).fit(Y)
+    knn_dist, knn_ind = nn.kneighbors(Y if query_ind is None else Y[query_ind])
+    return knn_ind, knn_dist
+
+
+def knn_recall(knn_ind, exact_ind):
+    '''
+    Fraction of the exact k nearest neighbors (rows of exact_ind) found in the rows of knn_ind
+    '''
+    k = exact_ind.shape[1]
+    return np.mean([np.intersect1d(a[:k], b).size / k for a, b in zip(knn_ind, exact_ind)])
+
+
+def _annoy_query(index, Y, inds, k, num, search_k):
+    # neighbors of the points in inds, with distances recomputed in double precision (annoy's are single)
+    chunk = max(1, 2**22 // (num * Y.shape[1]))
+    knn_ind = np.zeros((inds.size, k), dtype=int)
+    knn_dist = np.zeros((inds.size, k))
+    for start in range(0, inds.size, chunk):
+        rows = inds[start:start+chunk]
+        cand = np.array([index.get_nns_by_item(int(i), num, search_k=search_k) for i in rows])
+        dist = np.linalg.norm(Y[rows][:,np.newaxis,:] - Y[cand], axis=2)
+        order = np.argsort(dist, axis=1)[:,:k]
+        knn_ind[start:start+chunk] = np.take_along_axis(cand, order, axis=1)
+        knn_dist[start:start+chunk] = np.take_along_axis(dist, order, axis=1)
+    return knn_ind, knn_dist
+
+
+def annoy_knnsearch(X, k, similarity='euclidean', recall=0.95, n_trees=10, n_jobs=-1, sample=200, seed=0, verbose=True):
+    '''
+    Approximate k nearest neighbors (including the point itself) with annoy, built and queried in parallel. The
+    search effort (annoy's search_k) is doubled until the recall of the exact neighbors of sample random points
+    reaches recall, so the result has about that recall. Returns knn_ind, knn_dist as gl.weightmatrix.knnsearch.
+    '''
+    from annoy import AnnoyIndex
+
+    Y = _prepare(X, similarity)
+    n, m = Y.shape
+    num = min(2*k, n) # extra candidates, as gl.weightmatrix.knnsearch
+    n_jobs = effective_n_jobs(n_jobs)
+
+    index = AnnoyIndex(m, 'euclidean')
+    index.set_seed(seed)
+    for i in range(n):
+        index.add_item(i, Y[i])
+    index.build(n_trees, n_jobs=n_jobs)
+
+    # calibrate the search effort on a sample against exact neighbors
+    sample_ind = np.random.RandomState(seed).choice(n, min(sample, n), replace=False)
+    exact_ind, _ = exact_knnsearch(Y, k, query_ind=sample_ind, n_jobs=n_jobs)
+    search_k = n_trees*num
+    while True:
+        est = knn_recall(_annoy_query(index, Y, sample_ind, k, num, search_k)[0], exact_ind)
+        if est >= recall or search_k >= n_trees*n:
+            break
+        search_k *= 2
+    if verbose:
+        print(f"annoy knn search with {n_trees} trees, search_k = {search_k}: estimated recall {est:.4f} (target {recall})")
+
+    chunks = np.array_split(np.arange(n), max(1, 4*n_jobs))
+    results = Parallel(n_jobs=n_jobs, prefer="threads")(delayed(_annoy_query)(index, Y, inds, k, num, search_k)
+                                                        for inds in chunks)
+    knn_ind = np.vstack([res[0] for res in results])
+    knn_dist = np.vstack([res[1] for res in results])
+    return knn_ind, knn_dist
+
+
+def knnsearch(X, k, method='annoy', similarity='euclidean', recall=0.95, n_jobs=-1, **kwargs):
+    '''
+    k nearest neighbor search with a selectable backend: 'annoy' (see annoy_knnsearch) or 'exact' (see
+    exact_knnsearch). Returns knn_ind, knn_dist, which gl.weightmatrix.knn takes as knn_data.
+    '''
+    if method == 'annoy':
+        return annoy_knnsearch(X, k, similarity=similarity, recall=recall, n_jobs=n_jobs, **kwargs)
+    elif method == 'exact':
+        return exact_knnsearch(X, k, similarity=similarity, n_jobs=n_jobs)
+    raise ValueError(f"Invalid knn search method {method}, use 'annoy' or 'exact'")
@@ -9,7 +9,7 @@ import graphlearning as gl
 from test_al_gl import get_active_learner
 import pickle
 import acquisitions
-from utils import get_active_learner
+from utils import get_active_learner, load_stored_graph
 
 
 acq_color = {'random':'r', 'vopt':'cyan', 'voptfull':'grey',  'mcvopt':'k', 'sopt':'lime', 'soptfull':'magenta',
@@ -75,7 +75,7 @@ def plot_acc_toy(dataset="box", acq_to_show=["unc : rwll", "uncnorm : rwll0010",
     
     dataset_data = np.load(f"data/{dataset}_raw.npz")
     X, labels = dataset_data['data'], dataset_data['labels']
-    G = gl.graph.load(f"data/{dataset}_{knn}")
+    G = load_stored_graph(dataset, knn)
     
     for acq in acq_to_show:
         acq_name, modelname = acq.split(" : ")
@@ -0,0 +1,57 @@
+import os
+import yaml
+
+
+class task_costs:
+    """Task Costs
+    ===================
+
+    Wall-clock costs of active learning tasks measured on earlier runs, in seconds per active learning iteration,
+    keyed by dataset and "acquisition model" pair (as in the configuration files) and kept in a yaml file. Used to
+    schedule the tasks of a run longest first (see longest_first). Costs are only an ordering heuristic, so changes of
+    other settings (e.g., batch size or candidate pruning) between runs are not tracked.
+
+    Parameters
+    ----------
+    fname : str
+        Yaml file of the costs (e.g., results/task_costs.yaml), created on save if it does not exist.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.costs = {}
+        if os.path.exists(fname):
+            with open(fname, 'r') as f:
+                self.costs = yaml.safe_load(f) or {}
+
+    def estimate(self, dataset, acq_model, iters):
+        '''
+        Estimated seconds of a task of iters iterations, or None if it was never measured
+        '''
+        cost = self.costs.get(dataset, {}).get(acq_model)
+        return None if cost is None else cost * iters
+
+    def record(self, dataset, acq_model, iters, seconds):
+        '''
+        Record the measured seconds of a task of iters iterations, replacing earlier measurements
+        '''
+        self.costs.setdefault(dataset, {})[acq_model] = float(seconds) / max(iters, 1)
+
+    def save(self):
+        '''
+        Write the costs, atomically so an interrupted run never leaves a partial file
+        '''
+        os.makedirs(os.path.dirname(self.fname) or ".", exist_ok=True)
+        tmp_fname = f"{self.fname}.{os.getpid()}.tmp"
+        with open(tmp_fname, 'w') as f:
+            yaml.safe_dump(self.costs, f)
+        os.replace(tmp_fname, self.fname)
+
+
+def longest_first(tasks, estimates):
+    '''
+    Order tasks by decreasing estimated cost (longest processing time first), so the slowest tasks start first and
+    the run finishes close to the time of its longest task. Tasks without an estimate (None) come first, since they
+    may be the longest, and ties keep the order of tasks.
+    '''
+    order = sorted(range(len(tasks)), key=lambda i: (estimates[i] is not None, -(estimates[i] or 0.)))
+    return [tasks[i] for i in order]
@@ -0,0 +1,556 @@
+import os
+import numpy as np
+import scipy.sparse as sparse
+import scipy.sparse.linalg as splinalg
+from cache import graph_hash, load_array, save_array
+
+try:
+    from sksparse.cholmod import cholesky
+except ImportError:
+    cholesky = None
+
+
+# kNN graph Laplacians fill in badly under sparse factorization, so only factorize graphs up to this size by default
+DIRECT_MAX_NODES = 5000
+
+# Number of prior covariance columns solved and held in memory at once by covariance_operator
+COV_CHUNK = 64
+
+# Largest graph on which covariance_operator solves for the prior column of every node by default
+COV_EXACT_MAX_NODES = 5000
+
+# Default number of random probes of covariance_operator's estimated prior
+COV_PROBES = 64
+
+
+class poisson_solver:
+    """Poisson Solver
+    ===================
+
+    Base class for solvers of \\((L + \\tau I)x = f\\), built once per (graph, tau). The system matrix
+    is assembled on first use and dropped when pickling.
+
+    Parameters
+    ----------
+    graph : graphlearning graph object
+        Graph whose Laplacian defines the system.
+    tau : float, default=0.0
+        Diagonal shift added to the graph Laplacian.
+    normalization : str, default='combinatorial'
+        Normalization of the graph Laplacian.
+    dtype : numpy dtype, default=np.float64
+        Floating point type of the returned solutions.
+    """
+    iterative = False
+
+    def __init__(self, graph, tau=0.0, normalization='combinatorial', dtype=np.float64):
+        self.graph = graph
+        self.tau = tau
+        self.normalization = normalization
+        self.dtype = np.dtype(dtype)
+        self.n = graph.num_nodes
+        self.last_iters = 0
+        self._matrix = None
+
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            L = self.graph.laplacian(normalization=self.normalization)
+            if self.tau > 0.0:
+                L = L + self.tau*sparse.eye(self.n)
+            self._matrix = L.tocsr()
+        return self._matrix
+
+    def solve(self, F, x0=None, tol=None):
+        """Solve \\((L + \\tau I)X = F\\) for each column of F, from x0 to residual tol (iterative solvers only)
+        """
+        raise NotImplementedError("Must override solve")
+
+    def _clear(self):
+        self._matrix = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_matrix'] = None
+        return state
+
+
+class direct_solver(poisson_solver):
+    """Direct Solver
+    ===================
+
+    Cached sparse factorization of \\(L + \\tau I\\) (scikit-sparse Cholesky if installed, otherwise SuperLU).
+    Requires tau > 0.
+    """
+    def __init__(self, graph, tau=0.0, normalization='combinatorial', dtype=np.float64):
+        if tau <= 0.0:
+            raise ValueError("direct_solver requires tau > 0, the graph Laplacian itself is singular")
+        super().__init__(graph, tau, normalization, dtype)
+        self._factor = None
+
+    @property
+    def factor(self):
+        if self._factor is None:
+            if cholesky is not None:
+                self._factor = cholesky(self.matrix.tocsc())
+            else:
+                self._factor = splinalg.splu(self.matrix.tocsc(), permc_spec='MMD_AT_PLUS_A',
+                                             options=dict(SymmetricMode=True))
+        return self._factor
+
+    def solve(self, F, x0=None, tol=None):
+        F = np.asarray(F, dtype=np.float64)
+        if cholesky is not None:
+            return self.factor(F).astype(self.dtype, copy=False)
+        return self.factor.solve(F).astype(self.dtype, copy=False)
+
+    def _clear(self):
+        super()._clear()
+        self._factor = None
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_factor'] = None
+        return state
+
+
+class cg_solver(poisson_solver):
+    """Block Preconditioned Conjugate Gradient Solver
+    ===================
+
+    Jacobi-preconditioned block conjugate gradient (O'Leary, 1980) for \\(L + \\tau I\\). Columns share
+    one block of search directions and leave it once they converge.
+
+    Parameters
+    ----------
+    tol : float, default=1e-9
+        Default tolerance on the residual norm of each column.
+    max_iter : int, default=1e5
+        Maximum number of iterations.
+    block_size : int, default=32
+        Maximum number of right hand sides sharing one block of search directions.
+    dtype : numpy dtype, default=np.float64
+        With np.float32, iterates in single precision with iterative refinement in double precision.
+    max_refine : int, default=10
+        Maximum number of refinement steps in single precision.
+    """
+    iterative = True
+
+    def __init__(self, graph, tau=0.0, normalization='combinatorial', tol=1e-9, max_iter=1e5, block_size=32, 
+                 dtype=np.float64, max_refine=10):
+        super().__init__(graph, tau, normalization, dtype)
+        self.tol = tol
+        self.max_iter = max_iter
+        self.block_size = block_size
+        self.max_refine = max_refine
+        self._Minv = None
+        self._matrix32 = None
+
+    @property
+    def Minv(self):
+        if self._Minv is None:
+            self._Minv = 1./np.maximum(self.matrix.diagonal(), 1e-10)
+        return self._Minv
+
+    @property
+    def matrix32(self):
+        if self._matrix32 is None:
+            self._matrix32 = self.matrix.astype(np.float32)
+        return self._matrix32
+
+    def solve(self, F, x0=None, tol=None):
+        if tol is None:
+            tol = self.tol
+        tol = np.broadcast_to(tol, (F.shape[1],))
+        if self.dtype == np.float64:
+            return self._solve(self.matrix, self.Minv, F, x0, tol)
+
+        # iterative refinement: solve for the correction to X in single precision, against the residual in double precision
+        X = np.zeros(F.shape) if x0 is None else x0.astype(np.float64)
+        R = F - self.matrix @ X if x0 is not None else F.astype(np.float64)
+        norms = np.linalg.norm(R, axis=0)
+        # residual already caused by rounding the solution to dtype, no point refining below it
+        rounding = np.finfo(self.dtype).eps*abs(self.matrix).sum(axis=0).max()
+        iters = 0
+        for _ in range(self.max_refine):
+            active = np.where(norms > np.maximum(tol, rounding*np.linalg.norm(X, axis=0)))[0]
+            if active.size == 0:
+                break
+            # single precision CG reduces the residual by about 1e-6 before rounding errors take over
+            inner_tol = np.maximum(tol[active], 1e-6*norms[active]).astype(np.float32)
+            D = self._solve(self.matrix32, self.Minv.astype(np.float32), R[:,active].astype(np.float32), None, inner_tol)
+            iters += self.last_iters
+            X[:,active] += D
+            R[:,active] = F[:,active] - self.matrix @ X[:,active]
+            norms[active] = np.linalg.norm(R[:,active], axis=0)
+        self.last_iters = iters
+        return X.astype(self.dtype)
+
+    def _solve(self, A, Minv, F, x0, tol):
+        if x0 is None:
+            X = np.zeros_like(F)
+        else:
+            X = x0.copy()
+
+        self.last_iters = 0
+        for start in range(0, F.shape[1], self.block_size):
+            block = slice(start, start + self.block_size)
+            X[:,block], iters = self._block_solve(A, Minv, F[:,block], X[:,block], tol[block], x0 is None)
+            self.last_iters += iters
+        return X
+
+    def _block_solve(self, A, Minv, F, X, tol, zero_start):
+        Minv = Minv[:,np.newaxis]
+        R = F.copy() if zero_start else F - A @ X
+
+        # Only the active (unconverged) columns are iterated on, stored contiguously
+        active = np.where(np.linalg.norm(R, axis=0) > tol)[0]
+        Xa, Ra = X[:,active], R[:,active]
+        Z, AZ, T = None, None, None # search directions are P = Z @ T, with A @ P = AZ @ T
+        i = 0
+        while (active.size > 0) and (i < self.max_iter):
+            i += 1
+            Znew = Minv * Ra
+            if Z is not None:
+                Znew -= Z @ (T @ (T.T @ (AZ.T @ Znew))) # A-conjugate to the previous block of directions
+            Z = Znew
+            AZ = A @ Z
+
+            # A-orthonormalize the new block of search directions, dropping numerically dependent ones
+            G = Z.T @ AZ
+            d = np.sqrt(np.maximum(G.diagonal(), np.finfo(G.dtype).tiny))
+            s, U = np.linalg.eigh(G / np.outer(d, d))
+            keep = s > (1e-12 if G.dtype == np.float64 else 1e-5)*max(s.max(), 0.)
+            if not keep.any():
+                break
+            T = (U[:,keep] / np.sqrt(s[keep])) / d[:,np.newaxis]
+
+            beta = T @ (T.T @ (Z.T @ Ra))
+            Xa += Z @ beta
+            Ra -= AZ @ beta
+
+            converged = np.linalg.norm(Ra, axis=0) <= tol[active]
+            if converged.any():
+                X[:,active[converged]] = Xa[:,converged]
+                active, Xa, Ra = active[~converged], Xa[:,~converged], Ra[:,~converged]
+
+        X[:,active] = Xa
+        return X, i
+
+    def _clear(self):
+        super()._clear()
+        self._Minv = None
+        self._matrix32 = None
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_Minv'] = None
+        state['_matrix32'] = None
+        return state
+
+
+class spectral_solver(poisson_solver):
+    """Spectral Solver
+    ===================
+
+    Approximates \\((L + \\tau I)^{-1}\\) from the eigenpairs \\((\\Lambda, V)\\) in `graph.eigendata`,
+    \\[x = V(\\Lambda + \\tau I)^{-1}V^Tf + y,\\]
+    with the remainder y from a few Jacobi sweeps orthogonal to V.
+
+    Parameters
+    ----------
+    k : int (optional), default=None
+        Number of stored eigenpairs to use. Uses all stored eigenpairs if None.
+    smoothing_steps : int, default=5
+        Number of Jacobi sweeps for the remainder.
+    """
+    def __init__(self, graph, tau=0.0, normalization='combinatorial', k=None, smoothing_steps=5, dtype=np.float64):
+        if normalization not in ['combinatorial', 'normalized']:
+            raise ValueError(f"spectral_solver requires a symmetric Laplacian, not {normalization}")
+        if graph.eigendata[normalization]['eigenvectors'] is None:
+            raise ValueError(f"spectral_solver requires stored {normalization} eigendata, compute it with graph.eigen_decomp first")
+        super().__init__(graph, tau, normalization, dtype)
+        self.k = k
+        self.smoothing_steps = max(smoothing_steps, 1)
+
+    def solve(self, F, x0=None, tol=None):
+        evals = self.graph.eigendata[self.normalization]['eigenvalues'][:self.k]
+        V = self.graph.eigendata[self.normalization]['eigenvectors'][:,:self.k]
+        A, diag = self.matrix, self.matrix.diagonal()[:,np.newaxis]
+
+        coeffs = V.T @ F
+        X = V @ (coeffs / (evals + self.tau)[:,np.newaxis])
+
+        R = F - V @ coeffs
+        Y = np.zeros_like(F)
+        for _ in range(self.smoothing_steps):
+            AY = A @ Y
+            Y += (R - AY + V @ (V.T @ AY)) / diag
+            Y -= V @ (V.T @ Y)
+
+        return (X + Y).astype(self.dtype, copy=False)
+
+
+class multishift_cg_solver(poisson_solver):
+    """Multi-Shift Conjugate Gradient Solver
+    ===================
+
+    Solves \\((L + \\tau_s I)x_s = f\\) for several shifts \\(\\tau_s\\) at once with CG-M (Jegerlehner, 1996),
+    one matrix-vector product per iteration for all shifts. Unpreconditioned.
+
+    Parameters
+    ----------
+    taus : list of float
+        Diagonal shifts to solve for.
+    tol : float, default=1e-9
+        Default tolerance on the residual norm of each column of each shifted system.
+    max_iter : int, default=1e5
+        Maximum number of iterations.
+    """
+    iterative = True
+
+    def __init__(self, graph, taus, normalization='combinatorial', tol=1e-9, max_iter=1e5, dtype=np.float64):
+        self.taus = np.asarray(taus, dtype=float)
+        super().__init__(graph, tau=self.taus.min(), normalization=normalization, dtype=dtype)
+        self.tol = tol
+        self.max_iter = max_iter
+
+    def solve(self, F, x0=None, tol=None):
+        """Returns the solutions for each shift, shape (len(taus), n, m). x0 is not supported, and tol may be
+        given per shift and column, shape (len(taus), m).
+        """
+        if tol is None:
+            tol = self.tol
+        num_shifts, m = self.taus.size, F.shape[1]
+        tol = np.broadcast_to(tol, (num_shifts, m))
+        A = self.matrix
+        X = np.zeros((num_shifts,) + F.shape)
+
+        # working arrays hold only the active shifts and columns. Converged pairs of shifts and columns are
+        # frozen, and columns are compacted away in batches, since each compaction copies all shifted systems
+        shifts, cols = np.arange(num_shifts), np.arange(m)
+        sigma = (self.taus - self.tau)[:,np.newaxis] # shifts relative to the base system
+        r = F.copy()
+        p = r.copy()
+        Xs = np.zeros(X.shape)
+        ps = np.broadcast_to(r, X.shape).copy()
+        rr = np.einsum('ij,ij->j', r, r)
+        zeta, zeta_old = np.ones((num_shifts, m)), np.ones((num_shifts, m))
+        alpha_old, beta_old = np.ones(m), np.zeros(m)
+        conv = np.zeros((num_shifts, m), dtype=bool)
+
+        i = 0
+        while True:
+            conv |= np.abs(zeta)*np.sqrt(rr) <= tol[np.ix_(shifts, cols)]
+            done_shifts, done_cols = conv.all(axis=1), conv.all(axis=0)
+            if done_shifts.any() or done_cols.all() or (done_cols.sum() >= max(cols.size//4, 1)):
+                for k, s in enumerate(shifts):
+                    if done_shifts[k]:
+                        X[s][:,cols] = Xs[k]
+                    else:
+                        X[s][:,cols[done_cols]] = Xs[k][:,done_cols]
+                if done_shifts.all() or done_cols.all():
+                    break
+                ks, kc = ~done_shifts, ~done_cols
+                shifts, cols, sigma = shifts[ks], cols[kc], sigma[ks]
+                r, p, rr, alpha_old, beta_old = r[:,kc], p[:,kc], rr[kc], alpha_old[kc], beta_old[kc]
+                Xs, ps = Xs[ks][:,:,kc], ps[ks][:,:,kc]
+                zeta, zeta_old, conv = zeta[np.ix_(ks, kc)], zeta_old[np.ix_(ks, kc)], conv[np.ix_(ks, kc)]
+            if i >= self.max_iter:
+                for k, s in enumerate(shifts):
+                    X[s][:,cols] = Xs[k]
+                break
+            i += 1
+
+            Ap = A @ p
+            alpha = rr / np.maximum(np.einsum('ij,ij->j', p, Ap), 1e-300)
+            zeta_new = zeta*zeta_old*alpha_old / (alpha*beta_old*(zeta_old - zeta) + zeta_old*alpha_old*(1. + sigma*alpha))
+            zeta_new[conv] = zeta[conv] # freeze converged pairs of shifts and columns, before their zeta underflows
+            alpha_s = np.where(conv, 0., alpha*zeta_new/zeta)
+
+            r -= alpha*Ap
+            rr_new = np.einsum('ij,ij->j', r, r)
+            beta = rr_new/np.maximum(rr, 1e-300)
+            beta_s = np.where(conv, 0., beta*(zeta_new/zeta)**2)
+            p *= beta
+            p += r
+            for k in range(shifts.size): # one pass over each shifted system
+                Xs[k] += alpha_s[k]*ps[k]
+                ps[k] *= beta_s[k]
+                ps[k] += zeta_new[k]*r
+
+            zeta_old = np.where(conv, zeta_old, zeta)
+            zeta = zeta_new
+            alpha_old, beta_old, rr = alpha, beta, rr_new
+
+        self.last_iters = i
+        return X.astype(self.dtype, copy=False)
+
+
+SOLVERS = {'direct': direct_solver,
+           'cg': cg_solver,
+           'spectral': spectral_solver,
+           }
+
+
+def get_solver(graph, tau=0.0, method='auto', normalization='combinatorial', dtype=np.float64, **kwargs):
+    """Get Solver
+    ===================
+
+    Solver for \\((L + \\tau I)x = f\\). 'auto' is 'direct' for tau > 0 up to DIRECT_MAX_NODES nodes, 'cg' otherwise.
+    """
+    if method == 'auto':
+        method = 'direct' if (tau > 0.0 and graph.num_nodes <= DIRECT_MAX_NODES) else 'cg'
+    if method not in SOLVERS:
+        raise ValueError(f"Invalid solver method {method}, use 'auto' or one of {list(SOLVERS.keys())}")
+    return SOLVERS[method](graph, tau=tau, normalization=normalization, dtype=dtype, **kwargs)
+
+
+class covariance_operator:
+    """Covariance Operator
+    ===================
+
+    Matrix-free covariance of VOpt and SigmaOpt with the full covariance,
+    \\[C = C_0 - UU^T, \\quad C_0 = (L + \\delta I)^{-1},\\]
+    where each label adds a column to U (the rank-one updates of gl.active_learning.var_opt). The diagonal, column
+    norms and column sums of C follow from those of C_0 (the prior), which are solved for once per node, or on large
+    graphs estimated at all nodes from the lowest eigenvectors and num_probes random probes (Hutchinson).
+
+    Parameters
+    ----------
+    graph : graphlearning graph object
+        Graph whose Laplacian defines the prior.
+    delta : float, default=0.001
+        Diagonal shift making the prior precision invertible.
+    gamma2 : float, default=0.01
+        Label noise variance.
+    normalization : str, default='combinatorial'
+        Normalization of the graph Laplacian.
+    method : str, default='auto'
+        Solver for the columns of C_0 (see get_solver).
+    cache_dir : str (optional), default=None
+        Directory in which to keep the prior quantities (see cache.CACHE_DIR).
+    prior : {'auto','exact','estimate'}, default='auto'
+        How the prior is computed, 'auto' is 'exact' up to COV_EXACT_MAX_NODES nodes.
+    evecs : numpy array (optional), default=None
+        Lowest eigenvectors of the graph Laplacian, required to estimate the prior.
+    num_probes : int, default=COV_PROBES
+        Number of random probes of the estimated prior.
+    seed : int, default=0
+        Seed of the random probes.
+    """
+    def __init__(self, graph, delta=0.001, gamma2=0.01, normalization='combinatorial', method='auto', cache_dir=None, 
+                 prior='auto', evecs=None, num_probes=COV_PROBES, seed=0, **solver_kwargs):
+        self.graph = graph
+        self.n = graph.num_nodes
+        self.delta = delta
+        self.gamma2 = gamma2
+        self.solver = get_solver(graph, tau=delta, method=method, normalization=normalization, **solver_kwargs)
+        if normalization not in ['combinatorial', 'normalized']:
+            raise ValueError("covariance_operator requires a symmetric graph Laplacian ('combinatorial' or 'normalized')")
+        if prior == 'auto':
+            prior = 'exact' if self.n <= COV_EXACT_MAX_NODES else 'estimate'
+        if prior not in ['exact', 'estimate']:
+            raise ValueError(f"Invalid prior {prior}, use 'exact', 'estimate' or 'auto'")
+        if prior == 'estimate' and evecs is None:
+            raise ValueError(f"The estimated prior (used above {COV_EXACT_MAX_NODES} nodes by default) needs the lowest "
+                             "eigenvectors of the graph Laplacian, pass evecs")
+        self.estimate = prior == 'estimate'
+        self.evecs = evecs
+        self.num_probes = num_probes
+        self.seed = seed
+        self.fname = None
+        if cache_dir is not None:
+            name = f"{graph_hash(graph)}_{normalization}_{delta}"
+            if self.estimate:
+                name += f"_est{evecs.shape[1]}x{num_probes}_{seed}"
+            self.fname = os.path.join(cache_dir, "cov", f"{name}.npy")
+        self.prior = None
+        self.U = np.zeros((self.n, 0))
+        self.W = np.zeros((self.n, 0))
+
+    def _solve(self, F):
+        X = self.solver.solve(F)
+        return np.asarray(X, dtype=np.float64)
+
+    def _prior(self, ind):
+        # (C_0)_jj, ||C_0 e_j||^2 and (C_0 1)_j at the nodes in ind, solving for the columns not known yet
+        if self.prior is None:
+            self.prior = load_array(self.fname) if self.fname is not None else None
+            if self.prior is None or self.prior.shape != (3, self.n):
+                self.prior = np.full((3, self.n), np.nan)
+                self.prior[2] = self._solve(np.ones((self.n, 1)))[:,0]
+                if self.estimate:
+                    self.prior[:2] = self._estimate_prior()
+                    if self.fname is not None:
+                        save_array(self.fname, self.prior)
+            else:
+                self.prior = self.prior.copy()
+        missing = ind[np.isnan(self.prior[0, ind])]
+        for start in range(0, missing.size, COV_CHUNK):
+            chunk = missing[start:start+COV_CHUNK]
+            F = np.zeros((self.n, chunk.size))
+            F[chunk, np.arange(chunk.size)] = 1.
+            X = self._solve(F)
+            self.prior[0, chunk] = X[chunk, np.arange(chunk.size)]
+            self.prior[1, chunk] = (X * X).sum(axis=0)
+        if missing.size > 0 and self.fname is not None:
+            stored = load_array(self.fname) # merge with columns other processes solved for meanwhile
+            if stored is not None and stored.shape == self.prior.shape:
+                known = ~np.isnan(stored[0])
+                self.prior[:2, known] = stored[:2, known]
+            save_array(self.fname, self.prior)
+        return self.prior[:, ind]
+
+    def _estimate_prior(self):
+        # (C_0)_jj and ||C_0 e_j||^2 at all nodes: exact on the span of V, Hutchinson estimates of the rest R (R V = 0)
+        V = np.asarray(self.evecs, dtype=np.float64)
+        theta, Q = np.linalg.eigh(V.T @ (self.solver.matrix @ V)) # Ritz pairs of L + delta I
+        V = V @ Q
+        s = 1. / theta
+        V2 = V * V
+        R = np.zeros((2, self.n))
+        Z = np.random.RandomState(self.seed).choice([-1., 1.], size=(self.n, self.num_probes))
+        for start in range(0, self.num_probes, COV_CHUNK):
+            Zc = Z[:,start:start+COV_CHUNK]
+            RZ = self._solve(Zc - V @ (V.T @ Zc)) # C_0 applied to the part of the probes R sees, R Z
+            RZ -= V @ (V.T @ RZ)
+            R[0] += (Zc * RZ).sum(axis=1) / self.num_probes
+            R[1] += (RZ * RZ).sum(axis=1) / self.num_probes
+        return np.vstack((V2 @ s + np.maximum(R[0], 0.), V2 @ (s * s) + R[1])) # R is positive semidefinite
+
+    def columns(self, ind):
+        '''
+        Columns of C at the nodes in ind, as an n x len(ind) array
+        '''
+        F = np.zeros((self.n, ind.size))
+        F[ind, np.arange(ind.size)] = 1.
+        return self._solve(F) - self.U @ self.U[ind].T
+
+    def diagonal(self, ind):
+        '''
+        Diagonal entries C_jj at the nodes j in ind
+        '''
+        return self._prior(ind)[0] - (self.U[ind] ** 2.).sum(axis=1)
+
+    def column_norms2(self, ind):
+        '''
+        Squared norms ||C e_j||^2 of the columns of C at the nodes j in ind
+        '''
+        U = self.U[ind]
+        return self._prior(ind)[1] - 2.*(self.W[ind] * U).sum(axis=1) + ((U @ (self.U.T @ self.U)) * U).sum(axis=1)
+
+    def column_sums(self, ind):
+        '''
+        Sums 1^T C e_j of the columns of C at the nodes j in ind
+        '''
+        return self._prior(ind)[2] - self.U[ind] @ self.U.sum(axis=0)
+
+    def condition(self, k):
+        '''
+        Condition C on a (noisy) label at node k, the rank-one update C <- C - c_k c_k^T/(gamma2 + C_kk)
+        '''
+        c = self.columns(np.array([k]))[:,0]
+        u = c / np.sqrt(self.gamma2 + c[k])
+        self.U = np.hstack((self.U, u[:,np.newaxis]))
+        self.W = np.hstack((self.W, self._solve(u[:,np.newaxis])))
@@ -5,9 +5,13 @@ from tqdm import tqdm
 from argparse import ArgumentParser
 import pickle
 import os
+import time
 import yaml
 from copy import deepcopy
 from utils import *
+from candidates import candidate_index, candidate_pool
+from scheduler import task_costs, longest_first
+from tracker import accuracy_tracker
 
 from joblib import Parallel, delayed
 
@@ -23,6 +27,15 @@ if __name__ == "__main__":
     parser.add_argument("--resultsdir", type=str, default="results")
     parser.add_argument("--config", type=str, default="./config.yaml")
     parser.add_argument("--K", type=int, default=0)
+    parser.add_argument("--batchsize", type=int, default=1, help="number of query points labeled per iteration")
+    parser.add_argument("--evalevery", type=int, default=1, help="evaluate the accuracy every this many iterations (and after the last), NaN in between")
+    parser.add_argument("--knnmethod", type=str, default=None, help="knn search backend for building the graph ('annoy' or 'exact', see knn.py), graphlearning's default if not given")
+    parser.add_argument("--knnrecall", type=float, default=0.95, help="recall target of the 'annoy' knn search backend")
+    parser.add_argument("--pruneclusters", type=int, default=0, help="number of clusters of the coarse-to-fine candidate pruning (0 to score all candidates)")
+    parser.add_argument("--prunereps", type=int, default=4, help="representatives scored per cluster when pruning (more for higher recall of the best candidate, see README)")
+    parser.add_argument("--prunerefine", type=int, default=8, help="number of clusters whose candidates are all scored when pruning (more for higher recall, fewer for speed)")
+    parser.add_argument("--sparsetopk", type=int, default=0, help="keep only the largest sparsetopk entries of each propagation of the Dirichlet models (0 to keep all), required by dirichletvarindex")
+    parser.add_argument("--propcache", type=float, default=0., help="size cap in GiB of the on-disk propagation store of each Dirichlet model (one per tau, see cache.prop_store), 0 to not store propagations")
     args = parser.parse_args()
 
     # load in configuration file
@@ -30,8 +43,10 @@ if __name__ == "__main__":
         config = yaml.safe_load(f)
 
 
-    # Define ssl models and acquisition functions from configuration file 
+    # Define ssl models and acquisition functions from configuration file, each pair only once (repeated rows write 
+    # the same results files)
     ACQS_MODELS = [name for name in config["acqs_models"] if name.split(" ")[-1][:4] != "LAND"]
+    ACQS_MODELS = list(dict.fromkeys(ACQS_MODELS))
     acq_funcs_names = [name.split(" ")[0] for name in ACQS_MODELS]
     
 
@@ -44,9 +59,10 @@ if __name__ == "__main__":
     if args.K != 0:
         K = args.K     
     
-    # use only enough cores as length of models
-    if args.numcores > len(models):
-        args.numcores = len(models)
+    # coarse-to-fine candidate pruning, built once from the graph (see candidates.candidate_index)
+    index = None
+    if args.pruneclusters > 0:
+        index = candidate_index(models[0].graph, args.pruneclusters, reps=args.prunereps, refine=args.prunerefine)
 
 
     # define the seed set for the iterations. Allows for defining in the configuration file
@@ -56,67 +72,85 @@ if __name__ == "__main__":
         seeds = [0]
         print(f"Did not find 'seeds' in config file, defaulting to : {seeds}")
 
-    # Iterations for the different tests
-    for it, seed in enumerate(seeds):
-        # get initially labeled indices, based on the given seed
-        labeled_ind = gl.trainsets.generate(labels, rate=1, seed=seed)
-
-        # define the results directory for this seed's test
-        RESULTS_DIR = os.path.join(args.resultsdir, f"{args.dataset}_results_{seed}_{args.iters}")
-        if not os.path.exists(RESULTS_DIR):
-            os.makedirs(RESULTS_DIR)
-        np.save(os.path.join(RESULTS_DIR, "init_labeled.npy"), labeled_ind) # save initially labeled points that are common to each test
-
-
-        def active_learning_test(acq_func_name, model_name, model):
-            '''
-            Active learning test definition for parallelization.
-            '''
-
-            # check if test already completed previously
-            choices_run_savename = os.path.join(RESULTS_DIR, f"choices_{acq_func_name}_{model_name}.npy")
-            if os.path.exists(choices_run_savename):
-                print(f"Found choices already for {acq_func_name} in {model_name}")
-                return
-            
-            # fetch active_learning object
-            AL = get_active_learner(acq_func_name, model, labeled_ind, labels[labeled_ind], normalization, args)
-            
-            # If have a proportional sampling acquisition function then set K accordingly
-            if "prop" in acq_func_name:
-                AL.acq_function.set_K(K)
-
-
-            # restrict candidate set to non-outliers, as determined by a KDE estimator
-            if trainset is None:
-                candidate_ind_all = np.arange(model.graph.num_nodes)
+    # get initially labeled indices of each seed, and define the results directory of each seed's test
+    labeled_inds, RESULTS_DIRS = {}, {}
+    for seed in seeds:
+        labeled_inds[seed] = gl.trainsets.generate(labels, rate=1, seed=seed)
+        RESULTS_DIRS[seed] = os.path.join(args.resultsdir, f"{args.dataset}_results_{seed}_{args.iters}")
+        if not os.path.exists(RESULTS_DIRS[seed]):
+            os.makedirs(RESULTS_DIRS[seed])
+        np.save(os.path.join(RESULTS_DIRS[seed], "init_labeled.npy"), labeled_inds[seed]) # save initially labeled points that are common to each test
+
+
+    def active_learning_test(seed, acq_func_name, model_name, model):
+        '''
+        Active learning test definition for parallelization. Returns the task and its wall-clock time.
+        '''
+        start = time.time()
+        labeled_ind, RESULTS_DIR = labeled_inds[seed], RESULTS_DIRS[seed]
+
+        # fetch active_learning object
+        AL = get_active_learner(acq_func_name, model, labeled_ind, labels[labeled_ind], normalization, args)
+        
+        # If have a proportional sampling acquisition function then set K accordingly
+        if "prop" in acq_func_name:
+            AL.acq_function.set_K(K)
+
+
+        # restrict candidate set to non-outliers, as determined by a KDE estimator, and to the unlabeled nodes
+        pool = candidate_pool(model.graph.num_nodes, trainset)
+        print(f"{acq_func_name}, training_set size = {len(pool)}, dataset size = {model.graph.num_nodes}")
+        pool.remove(AL.labeled_ind)
+
+        # Calculate initial accuracy, accuracies are tracked incrementally (see tracker.accuracy_tracker)
+        tracker = accuracy_tracker(labels, args.iters, every=args.evalevery)
+        tracker.step(AL)
+        
+        
+        # Perform active learning iterations
+        for j in tqdm(range(args.iters), desc=f"{args.dataset}, {acq_func_name} test {seeds.index(seed)+1}/{len(seeds)}, seed = {seed}"):
+            candidate_ind = pool.candidates
+            if index is not None:
+                candidate_ind = index.prune(AL.acq_function, AL.u, candidate_ind)
+            if hasattr(AL.acq_function, "select"): # custom selection (e.g., dirichletvarindex, dirichletvarbatch)
+                query_points = AL.acq_function.select(AL.u, candidate_ind, batch_size=args.batchsize)
             else:
-                candidate_ind_all = trainset.copy()
-            
+                query_points = AL.select_queries(candidate_ind=candidate_ind, batch_size=args.batchsize) 
+            query_labels = labels[query_points] 
+            AL.update(query_points, query_labels)
+            pool.remove(query_points)
             
-            print(f"{acq_func_name}, training_set size = {candidate_ind_all.size}, dataset size = {model.graph.num_nodes}")
+            # update accuracies
+            tracker.step(AL)
+        acc = tracker.acc
+
+        acc_dir = os.path.join(RESULTS_DIR, model_name)
+        if not os.path.exists(acc_dir):
+            os.makedirs(acc_dir)
+        np.save(os.path.join(acc_dir, f"acc_{acq_func_name}_{model_name}.npy"), acc)
+        np.save(os.path.join(RESULTS_DIR, f"choices_{acq_func_name}_{model_name}.npy"), AL.labeled_ind)
+        return seed, acq_func_name, model_name, time.time() - start
+
+
+    # one pool of tasks over seeds x (acquisition function, model) pairs, skipping those completed previously, 
+    # ordered longest first by the costs measured on earlier runs (see scheduler.py)
+    tasks = []
+    for seed in seeds:
+        for acq_func_name, model_name, model in zip(acq_funcs_names, model_names, models):
+            if os.path.exists(os.path.join(RESULTS_DIRS[seed], f"choices_{acq_func_name}_{model_name}.npy")):
+                print(f"Found choices already for {acq_func_name} in {model_name}, seed = {seed}")
+                continue
+            tasks.append((seed, acq_func_name, model_name, model))
+    costs = task_costs(os.path.join(args.resultsdir, "task_costs.yaml"))
+    tasks = longest_first(tasks, [costs.estimate(args.dataset, f"{acq} {mdlname}", args.iters) for _, acq, mdlname, _ in tasks])
+    
+    # use only enough cores as tasks
+    numcores = max(1, min(args.numcores, len(tasks)))
 
-            # Calculate initial accuracy
-            acc = np.array([gl.ssl.ssl_accuracy(AL.model.predict(), labels, AL.labeled_ind)])
-            
-            
-            # Perform active learning iterations
-            for j in tqdm(range(args.iters), desc=f"{args.dataset}, {acq_func_name} test {it+1}/{len(seeds)}, seed = {seed}"):
-                query_points = AL.select_queries(candidate_ind=np.setdiff1d(candidate_ind_all, AL.labeled_ind)) 
-                query_labels = labels[query_points] 
-                AL.update(query_points, query_labels)
-                
-                # update accuracies
-                acc = np.append(acc, gl.ssl.ssl_accuracy(AL.model.predict(), labels, AL.labeled_ind))
-
-            acc_dir = os.path.join(RESULTS_DIR, model_name)
-            if not os.path.exists(acc_dir):
-                os.makedirs(acc_dir)
-            np.save(os.path.join(acc_dir, f"acc_{acq_func_name}_{model_name}.npy"), acc)
-            np.save(os.path.join(RESULTS_DIR, f"choices_{acq_func_name}_{model_name}.npy"), AL.labeled_ind)
-            return
-
-        print("------Starting Active Learning Tests-------")
-
-        Parallel(n_jobs=args.numcores)(delayed(active_learning_test)(acq_name, mdlname, mdl) for acq_name, mdlname, mdl \
-                in zip(acq_funcs_names, model_names, models))
+    print(f"------Starting Active Learning Tests ({len(tasks)} tasks on {numcores} cores)-------")
+    
+    # tasks are dispatched one at a time in order, and costs recorded as they finish
+    for seed, acq_name, mdlname, seconds in Parallel(n_jobs=numcores, batch_size=1, return_as="generator_unordered")(
+            delayed(active_learning_test)(*task) for task in tasks):
+        costs.record(args.dataset, f"{acq_name} {mdlname}", args.iters, seconds)
+        costs.save()
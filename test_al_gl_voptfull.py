@@ -8,6 +8,7 @@ import os
 import yaml
 from copy import deepcopy
 from utils import *
+from candidates import candidate_pool
 
 
 from joblib import Parallel, delayed
@@ -125,11 +126,12 @@ if __name__ == "__main__":
 
 
         # Perform active learning iterations
+        pool = candidate_pool(model.graph.num_nodes, labeled_ind=current_inds)
         for j in tqdm(range(ninit-1, args.iters), desc=f"{args.dataset}, {v_or_s}optfull test, seed = {s}"):
-            # take random sample 
-            unlabeled_inds = np.delete(np.arange(model.graph.num_nodes), current_inds)
-            candidate_set = np.random.choice(unlabeled_inds, 500, replace=False)
+            # take random sample, from the candidates in increasing order so that seeds give the same samples as before
+            candidate_set = np.random.choice(pool.sorted(), 500, replace=False)
             query_inds = solve_vopt_subset(model.graph.laplacian(), current_inds, candidate_set, sopt=sopt_flag)
+            pool.remove(query_inds)
             current_inds = np.append(current_inds, query_inds)
             current_labels = np.append(current_labels, labels[query_inds])
 
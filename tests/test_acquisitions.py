@@ -0,0 +1,32 @@
+import numpy as np
+import graphlearning as gl
+import pytest
+from dirichlet import dirichlet_learning
+from acquisitions import dirichlet_var, dirichlet_var_index
+from candidates import candidate_pool
+
+
+@pytest.fixture(scope="module")
+def W():
+    X = np.random.RandomState(0).rand(500, 2)
+    return gl.weightmatrix.knn(X, 10)
+
+
+def test_var_index_picks_max_variance(W):
+    labels = np.random.RandomState(1).randint(3, size=500)
+    model = dirichlet_learning(W, tau=0.1, sparse_topk=50)
+    AL = gl.active_learning.active_learner(model, dirichlet_var_index, np.array([0, 1, 2]), labels[[0, 1, 2]], tol=0.)
+    pool = candidate_pool(500, labeled_ind=AL.labeled_ind)
+    for _ in range(20):
+        query = AL.acq_function.select(AL.u, pool.candidates, batch_size=2)
+        exact = dirichlet_var().compute(AL.u, pool.candidates)
+        assert np.allclose(np.sort(dirichlet_var().compute(AL.u, query)), np.sort(exact)[-2:])
+        AL.update(query, labels[query])
+        pool.remove(query)
+
+
+def test_var_index_needs_truncated_propagations(W):
+    model = dirichlet_learning(W, tau=0.1)
+    AL = gl.active_learning.active_learner(model, dirichlet_var_index, np.array([0, 1, 2]), np.array([0, 1, 2]))
+    with pytest.raises(ValueError):
+        AL.acq_function.select(AL.u, np.arange(3, 500))
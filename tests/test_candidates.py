@@ -0,0 +1,15 @@
+import numpy as np
+from candidates import candidate_pool
+
+
+def test_pool_matches_delete():
+    n, labeled = 1000, np.arange(10)
+    pool = candidate_pool(n, labeled_ind=labeled)
+    rand_state = np.random.RandomState(0)
+    for _ in range(50):
+        query = rand_state.choice(pool.candidates, 3, replace=False)
+        labeled = np.append(labeled, query)
+        pool.remove(query)
+        unlabeled = np.delete(np.arange(n), labeled)
+        assert np.array_equal(pool.sorted(), unlabeled)
+        assert np.array_equal(np.sort(pool.candidates), unlabeled)
@@ -0,0 +1,36 @@
+import numpy as np
+import graphlearning as gl
+import pytest
+from dirichlet import dirichlet_learning
+
+
+@pytest.fixture(scope="module")
+def W():
+    X = np.random.RandomState(0).rand(200, 2)
+    return gl.weightmatrix.knn(X, 10)
+
+
+def fitted_A(W, train_ind, train_labels):
+    model = dirichlet_learning(W, tau=0.1)
+    model.fit(np.array(train_ind), np.array(train_labels))
+    return model.A
+
+
+@pytest.mark.parametrize("keep_props", [True, False])
+def test_relabel_and_remove_match_refit(W, keep_props):
+    model = dirichlet_learning(W, tau=0.1, keep_props=keep_props)
+    model.fit(np.array([0, 1, 2]), np.array([0, 1, 1]))
+
+    model.relabel(0, 1) # class 0 loses its only label
+    assert np.allclose(model.A, fitted_A(W, [0, 1, 2], [1, 1, 1]))
+    model.relabel(0, 2) # a new class, so the number of classes changes
+    assert np.allclose(model.A, fitted_A(W, [0, 1, 2], [2, 1, 1]))
+    model.remove_label(0)
+    assert np.allclose(model.A, fitted_A(W, [1, 2], [1, 1]))
+
+
+def test_leave_one_out_needs_props(W):
+    model = dirichlet_learning(W, tau=0.1, keep_props=False)
+    model.fit(np.array([0, 1, 2]), np.array([0, 1, 1]))
+    with pytest.raises(ValueError):
+        model.leave_one_out()
@@ -0,0 +1,27 @@
+import numpy as np
+import graphlearning as gl
+import pytest
+from solvers import covariance_operator
+
+
+@pytest.fixture(scope="module")
+def G():
+    X = np.random.RandomState(0).rand(500, 2)
+    return gl.graph(gl.weightmatrix.knn(X, 10))
+
+
+def test_estimated_prior_close_to_exact(G):
+    ind = np.arange(G.num_nodes)
+    exact = covariance_operator(G, prior='exact')
+    evals, evecs = G.eigen_decomp(k=50, method='exact')
+    est = covariance_operator(G, prior='estimate', evecs=evecs, num_probes=256)
+    d, de = exact.diagonal(ind), est.diagonal(ind)
+    c, ce = exact.column_norms2(ind), est.column_norms2(ind)
+    assert np.median(np.abs(de - d) / d) < 0.05
+    assert np.median(np.abs(ce - c) / c) < 0.01
+    assert np.allclose(est.column_sums(ind), exact.column_sums(ind))
+
+
+def test_estimated_prior_needs_evecs(G):
+    with pytest.raises(ValueError):
+        covariance_operator(G, prior='estimate')
@@ -0,0 +1,100 @@
+import numpy as np
+import graphlearning as gl
+from dirichlet import dirichlet_posterior
+
+
+class accuracy_tracker:
+    """Accuracy Tracker
+    ===================
+
+    Accuracy of an active learner's model over the course of active learning (as gl.ssl.ssl_accuracy, on the nodes
+    that are not labeled and have a nonnegative true label), every every-th iteration, kept in a preallocated buffer.
+
+    For Dirichlet models (dirichlet.dirichlet_learning without class priors) predictions are updated incrementally.
+    The tracker keeps a lower bound on the margin of each node's argmax over the other classes of A, which a change e
+    (in l1) of the node's row lowers by at most e. By the model's row_change, only the nodes whose margin may have
+    run out, which are within the support of the new propagations, get their argmax recomputed, and the counts of
+    correct predictions are updated for those and the newly labeled nodes. Other models are evaluated in full.
+
+    Parameters
+    ----------
+    labels : numpy array
+        True labels of all nodes.
+    iters : int
+        Number of active learning iterations.
+    every : int, default=1
+        Evaluate every every-th iteration (and after the last), the accuracies of other iterations are NaN.
+    """
+    def __init__(self, labels, iters, every=1):
+        self.labels = labels
+        self.iters = iters
+        self.every = every
+        self.acc = np.full(iters + 1, np.nan)
+        self.it = 0
+        self.A = None
+
+    def due(self, it=None):
+        '''
+        Whether the accuracy is evaluated at iteration it (the next one if None)
+        '''
+        it = self.it if it is None else it
+        return (it % self.every == 0) or (it == self.iters)
+
+    def step(self, AL):
+        '''
+        Record the accuracy of the active learner AL at the current iteration if due, and move to the next one.
+        Returns the accuracy (NaN if not evaluated).
+        '''
+        if self.due():
+            self.acc[self.it] = self.evaluate(AL.model, AL.u, AL.labeled_ind)
+        self.it += 1
+        return self.acc[self.it - 1]
+
+    def evaluate(self, model, u, labeled_ind):
+        '''
+        Accuracy of model (with output u of its latest fit) with labeled nodes labeled_ind
+        '''
+        if not isinstance(u, dirichlet_posterior) or u.row_change is None or model.class_priors is not None:
+            self.A = None
+            return gl.ssl.ssl_accuracy(model.predict(), self.labels, labeled_ind)
+
+        if u.A is not self.A: # new (or refit) model, predict all nodes
+            self.A = u.A
+            self.seen = u.row_change.copy()
+            self.change = np.zeros(self.labels.size)
+            self.evaluated = self.labels >= 0 # nodes counted in the accuracy
+            self.evaluated[labeled_ind] = False
+            self.correct = np.zeros(self.labels.size, dtype=bool)
+            self.margin = np.zeros(self.labels.size)
+            self.mass = np.zeros(self.labels.size)
+            self._predict(np.arange(self.labels.size))
+            self.num_correct = np.count_nonzero(self.correct[self.evaluated])
+            self.num_evaluated = np.count_nonzero(self.evaluated)
+        else:
+            new = labeled_ind[self.evaluated[labeled_ind]]
+            new = new[np.unique(new, return_index=True)[1]] # repeated labels counted once
+            self.num_correct -= np.count_nonzero(self.correct[new])
+            self.num_evaluated -= new.size
+            self.evaluated[new] = False
+
+            change = np.subtract(u.row_change, self.seen, out=self.change)
+            self.seen[:] = u.row_change
+            self.margin -= change
+            self.mass += change
+            # argmax may have changed where the margin ran out, up to the rounding of A's entries
+            stale = np.where(self.margin <= 8.*np.finfo(self.A.dtype).eps*self.mass)[0]
+            counted = self.evaluated[stale]
+            self.num_correct -= np.count_nonzero(self.correct[stale][counted])
+            self._predict(stale)
+            self.num_correct += np.count_nonzero(self.correct[stale][counted])
+
+        return 100.*(self.num_correct / self.num_evaluated) # rounded as gl.ssl.ssl_accuracy
+
+    def _predict(self, ind):
+        # argmax, margin over the other classes and sum of the rows of A at the nodes in ind
+        rows = self.A[ind].astype(np.float64)
+        pred = np.argmax(rows, axis=1)
+        top2 = -np.partition(-rows, 1, axis=1)[:,:2] if rows.shape[1] > 1 else np.hstack((rows, np.zeros_like(rows)))
+        self.correct[ind] = pred == self.labels[ind]
+        self.margin[ind] = top2[:,0] - top2[:,1]
+        self.mass[ind] = rows.sum(axis=1)
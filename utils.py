@@ -2,26 +2,54 @@ import graphlearning as gl
 import os
 import numpy as np
 import scipy.sparse as sparse
-from copy import deepcopy
 import acquisitions
 from dirichlet import dirichlet_learning
+from cache import CACHE_DIR, eig_store, graph_store
+from knn import knnsearch
+from solvers import COV_EXACT_MAX_NODES
 
 
 
-def get_models(G, model_names):
-    MODELS = {'poisson': gl.ssl.poisson(G),  # poisson learning
-              'laplace': gl.ssl.laplace(G), # laplace learning
-              'rwll1000': gl.ssl.laplace(G, tau=0.1, reweighting='poisson'),  # poisson-reweighted laplace learning
-              'dirichlet1000' : dirichlet_learning(G, tau=0.1),
-              'dirichlet0100': dirichlet_learning(G, tau=0.01),
-              'dirichlet0010': dirichlet_learning(G, tau=0.001),
-              'dirichlet0001': dirichlet_learning(G, tau=0.0001),
-              }
+# Constructors of the available models by name, only called for the models requested (see get_models). 
+# Keyword arguments are passed on to the Dirichlet models
+MODELS = {'poisson': lambda G, **kwargs: gl.ssl.poisson(G),  # poisson learning
+          'laplace': lambda G, **kwargs: gl.ssl.laplace(G), # laplace learning
+          'rwll1000': lambda G, **kwargs: gl.ssl.laplace(G, tau=0.1, reweighting='poisson'),  # poisson-reweighted laplace learning
+          'dirichlet1000' : lambda G, **kwargs: dirichlet_learning(G, tau=0.1, cache_dir=CACHE_DIR, **kwargs),
+          'dirichlet0100': lambda G, **kwargs: dirichlet_learning(G, tau=0.01, cache_dir=CACHE_DIR, **kwargs),
+          'dirichlet0010': lambda G, **kwargs: dirichlet_learning(G, tau=0.001, cache_dir=CACHE_DIR, **kwargs),
+          'dirichlet0001': lambda G, **kwargs: dirichlet_learning(G, tau=0.0001, cache_dir=CACHE_DIR, **kwargs),
+          }
 
-    return [deepcopy(MODELS[name]) for name in model_names]
+def get_models(G, model_names, propcache=0., sparsetopk=None):
+    """
+        Construct the models in model_names, and only those. Each is a new model, but all share the one graph G
+        (and its eigendata) instead of holding copies of it, so G's weight matrix is made read-only. propcache is 
+        the size cap in GiB of the on-disk propagation store of each Dirichlet model (0 to not store propagations),
+        and sparsetopk the number of entries kept of each of their propagations (all if None).
+    """
+    W = G.weight_matrix
+    for arr in [W.data, W.indices, W.indptr]:
+        arr.flags.writeable = False
+    return [MODELS[name](G, prop_store_bytes=int(propcache*2**30), sparse_topk=sparsetopk) for name in model_names]
+
+
+def get_graph_store(dataset, knn=20, data_dir="data"):
+    """
+        Store of the knn graph of dataset built by load_graph (see cache.graph_store), under data_dir/cache/graphs
+    """
+    return graph_store(os.path.join(data_dir, "cache", "graphs", f"{dataset.split('-')[0]}_{knn}"))
 
+def load_stored_graph(dataset, knn=20, data_dir="data"):
+    """
+        The knn graph of dataset built by load_graph, from its graph store or from a pickle of earlier versions
+    """
+    G = get_graph_store(dataset, knn, data_dir).load()
+    if G is None:
+        G = gl.graph.load(os.path.join(data_dir, f"{dataset.split('-')[0]}_{knn}"))
+    return G
 
-def load_graph(dataset, metric, numeigs=200, data_dir="data", returnX=False, returnK=False):
+def load_graph(dataset, metric, numeigs=200, data_dir="data", returnX=False, returnK=False, knn_method=None, knn_recall=0.95):
     X, clusters = gl.datasets.load(dataset.split("-")[0], metric=metric)
     if dataset.split("-")[-1] == 'evenodd':
         labels = clusters % 2
@@ -54,34 +82,36 @@ def load_graph(dataset, metric, numeigs=200, data_dir="data", returnX=False, ret
     
     print(f"Eigendata calculation will be {method}")
 
-    try:
-        G = gl.graph.load(graph_filename)
-        found = True
-    except:
-        if metric == "hsi":
-            sim_name ="angular" # LAND does 100 in HSI
-        else:
-            sim_name = "euclidean"
-        knn_ind, knn_dist = gl.weightmatrix.knnsearch(X, knn, similarity=sim_name, metric=metric, dataset=dataset.split("-")[0])
-        W = gl.weightmatrix.knn(X, knn, knn_data=(knn_ind, knn_dist), metric=metric)
-        G = gl.graph(W)
-        found = False
-
-    if numeigs is not None:
-        eigdata = G.eigendata[normalization]['eigenvalues']
-        if eigdata is not None:
-            prev_numeigs = eigdata.size
-            if prev_numeigs >= numeigs:
-                print("Retrieving Eigendata...")
+    # graphs are kept as memory-mapped arrays (see cache.graph_store), graphs pickled by earlier versions are migrated.
+    # Eigendata are read from the eigendata store when needed (see get_eig_data)
+    store = get_graph_store(dataset, knn, data_dir)
+    G = store.load()
+    if G is None:
+        try:
+            G = gl.graph.load(graph_filename)
+        except:
+            if metric == "hsi":
+                sim_name ="angular" # LAND does 100 in HSI
             else:
-                print(f"Requested {numeigs} eigenvalues, but have only {prev_numeigs} stored. Recomputing Eigendata...")
-        else:
-            print(f"No Eigendata found, so computing {numeigs} eigenvectors...")
-
-        evals, evecs = G.eigen_decomp(normalization=normalization, k=numeigs, method=method)
-
+                sim_name = "euclidean"
+            if knn_method is None:
+                knn_ind, knn_dist = gl.weightmatrix.knnsearch(X, knn, similarity=sim_name, metric=metric, dataset=dataset.split("-")[0])
+            else: # selectable backend, e.g., parallel annoy with a recall target (see knn.py)
+                knn_ind, knn_dist = knnsearch(X, knn, method=knn_method, similarity=sim_name, recall=knn_recall)
+            W = gl.weightmatrix.knn(X, knn, knn_data=(knn_ind, knn_dist), metric=metric)
+            G = gl.graph(W)
+        store.save(G)
+        for norm, eigdata in G.eigendata.items():
+            if eigdata['eigenvalues'] is not None:
+                estore = eig_store(CACHE_DIR, G, norm, eigdata['method'])
+                if estore.load(eigdata['eigenvalues'].size)[0] is None:
+                    estore.save(eigdata['eigenvalues'], eigdata['eigenvectors'])
+        G = store.load() # the stored, file-backed copy, which joblib workers receive by reference
+    else:
+        store.save(G) # adds arrays missing from stores of earlier versions
 
-    G.save(graph_filename)
+    if numeigs is not None:
+        evals, evecs = get_eig_data(G, normalization, numeigs, method=method)
     
     if returnX:
         return G, labels, trainset, normalization, X
@@ -92,26 +122,77 @@ def load_graph(dataset, metric, numeigs=200, data_dir="data", returnX=False, ret
     return G, labels, trainset, normalization
 
 
-def get_eig_data(G, normalization, numeigs):
-    # determine if need to recompute eigenvalues/vectors
-    recompute = True
-    if G.eigendata[normalization]['eigenvalues'] is not None:
-        if G.eigendata[normalization]['eigenvalues'].size < numeigs:
-            recompute = True
-    else:
-        recompute = True
-        
-    if not recompute:
-        # Current gl.active_learning is implemented only to allow for exact eigendata compute for "normalized"
+def get_eig_data(G, normalization, numeigs, method=None):
+    '''
+    Lowest numeigs eigenpairs of the graph Laplacian. Served from G.eigendata or the on-disk eigendata store
+    (cache.eig_store) when they hold enough eigenpairs, otherwise a stored basis is extended (see extend_eig_data),
+    and only without one are they computed from scratch. The (largest) result is kept in G.eigendata and the store.
+    The eigenvectors returned (and kept in G.eigendata) are read-only memory maps of the store, so learners and
+    joblib workers (which pass memory maps by reference) all share one copy. method defaults to 'exact' below 
+    100000 nodes and 'lowrank' above, as in load_graph.
+    '''
+    if method is None:
+        method = "exact" if G.num_nodes < 100000 else "lowrank"
+    eigdata = G.eigendata[normalization]
+    if eigdata['eigenvalues'] is not None and eigdata['eigenvalues'].size >= numeigs:
         print(f"Using previously stored {normalization} eigendata with {numeigs} evals")
-        evals = G.eigendata[normalization]['eigenvalues'][:numeigs]
-        evecs = G.eigendata[normalization]['eigenvectors'][:,:numeigs] 
-        
+        return eigdata['eigenvalues'][:numeigs], eigdata['eigenvectors'][:,:numeigs]
+
+    store = eig_store(CACHE_DIR, G, normalization, method)
+    evals, evecs = store.load()
+    if (evals is None or evals.size < numeigs) and eigdata['eigenvalues'] is not None \
+            and (evals is None or eigdata['eigenvalues'].size > evals.size):
+        evals, evecs = eigdata['eigenvalues'], eigdata['eigenvectors']
+    
+    if evals is not None and evals.size >= numeigs:
+        print(f"Loaded {normalization} eigendata with {evals.size} evals from {store.dir}")
+    elif evals is not None:
+        print(f"Extending stored {normalization} eigendata from {evals.size} to {numeigs} evals...")
+        evals, evecs = extend_eig_data(G, normalization, evals, evecs, numeigs)
+        store.save(evals, evecs)
     else:
-        print("Warning: Computing eigendata with gl.active_learning defaults...")
-        evals, evecs = G.eigen_decomp(normalization, k=numeigs)
+        print(f"No eigendata found, so computing {numeigs} {normalization} eigenvectors ({method})...")
+        evals, evecs = G.eigen_decomp(normalization=normalization, k=numeigs, method=method)
+        store.save(evals, evecs)
+    if not isinstance(evecs, np.memmap): # computed here (or unpickled with G), swap in the shared copy
+        evals, evecs = store.load()
 
-    return evals, evecs
+    # record as G.eigen_decomp would, so its own calls with default arguments reuse them
+    eigdata.update(eigenvalues=evals, eigenvectors=evecs, method=method, k=evals.size, c=2*evals.size, gamma=0, tol=0, q=1)
+    return evals[:numeigs], evecs[:,:numeigs]
+
+
+def extend_eig_data(G, normalization, evals, evecs, numeigs, tol=0):
+    '''
+    Extend the lowest eigenpairs evals, evecs of the graph Laplacian (as computed by G.eigen_decomp) to numeigs, with
+    Lanczos iterations (scipy eigsh) on the operator G.eigen_decomp diagonalizes, deflated by the known eigenpairs.
+    Only the numeigs - evals.size new eigenpairs are iterated for, rather than all numeigs from scratch.
+    '''
+    n = G.num_nodes
+    if normalization == 'combinatorial':
+        M = 2*np.max(G.degree_vector())
+        A = M*sparse.identity(n) - G.laplacian()
+        s, U = M - evals, evecs
+    else:
+        D = G.degree_matrix(p=-0.5)
+        A = D*G.weight_matrix*D
+        s = 1. - evals
+        U = evecs if normalization == 'normalized' else G.degree_matrix(p=0.5)@evecs
+    A = A.tocsr()
+    U = np.asarray(U)
+
+    def matmat(X):
+        X = X.reshape(n, -1)
+        return A@X - U@(s[:,np.newaxis]*(U.T@X))
+    op = sparse.linalg.LinearOperator((n, n), matvec=matmat, matmat=matmat, dtype=np.float64)
+    w, X = sparse.linalg.eigsh(op, k=numeigs - evals.size, which='LA', tol=tol)
+    
+    new_evals = M - w if normalization == 'combinatorial' else 1. - w
+    ind = np.argsort(new_evals)
+    new_evals, X = new_evals[ind], X[:,ind]
+    if normalization == 'randomwalk':
+        X = D@X
+    return np.concatenate((evals, new_evals)), np.hstack((evecs, X))
 
 
 def get_unc_acq_func(af_name):
@@ -141,6 +222,12 @@ def get_active_learner(acq_func_name, model, labeled_ind, labeled_ind_labels, no
 
     if af_name == "dirichletvar":
         AL = gl.active_learning.active_learner(model, acquisitions.dirichlet_var, labeled_ind.copy(), labeled_ind_labels.copy())
+    elif af_name == "dirichletvarindex":
+        if getattr(model, "sparse_topk", None) is None and getattr(model, "sparse_thresh", None) is None:
+            raise ValueError("dirichletvarindex needs Dirichlet models with truncated propagations, run with --sparsetopk")
+        AL = gl.active_learning.active_learner(model, acquisitions.dirichlet_var_index, labeled_ind.copy(), labeled_ind_labels.copy())
+    elif af_name == "dirichletvarbatch":
+        AL = gl.active_learning.active_learner(model, acquisitions.dirichlet_var_batch, labeled_ind.copy(), labeled_ind_labels.copy(), dirichlet_model=model)
     elif af_name == "dirichletvarprop":
         AL = gl.active_learning.active_learner(model, acquisitions.dirichlet_varprop, labeled_ind.copy(), labeled_ind_labels.copy())
     elif af_name in ["mc", "mcvopt", "vopt", "sopt"]:
@@ -149,7 +236,7 @@ def get_active_learner(acq_func_name, model, labeled_ind, labeled_ind_labels, no
         if acq_func_name.split("-")[0][-1] == "1":
             evals = evals[1:] 
             V = V[:,1:]
-        C = np.linalg.inv(np.diag(evals + 1e-11))
+        C = np.linalg.inv(np.diag(evals + 1e-11)) # numeigs x numeigs, copied (and updated) by each acquisition function
 
         if af_name == "mc":
             acq_func = gl.active_learning.model_change
@@ -160,18 +247,22 @@ def get_active_learner(acq_func_name, model, labeled_ind, labeled_ind_labels, no
         elif af_name == "sopt":
             acq_func = gl.active_learning.sigma_opt
 
-        AL = gl.active_learning.active_learner(model, acq_func, labeled_ind.copy(), labeled_ind_labels.copy(), C=C.copy(), V=V.copy(), gamma2=args.gamma**2.)
+        AL = gl.active_learning.active_learner(model, acq_func, labeled_ind.copy(), labeled_ind_labels.copy(), C=C, V=V, gamma2=args.gamma**2.) # V is only read, not copied
         
     elif af_name in ["voptfull", "soptfull"]:
-        # add a small diagonal term to make C invertible
-        C = sparse.linalg.inv(sparse.csc_matrix(model.graph.laplacian(normalization=normalization) + 
-                                                                       0.001*sparse.eye(model.graph.num_nodes))).toarray() 
+        # full covariance (L + 0.001 I)^{-1}, kept matrix-free (see solvers.covariance_operator), whose prior is 
+        # estimated from numeigs eigenvectors on large graphs
         if af_name == "voptfull":
-            acq_func = gl.active_learning.var_opt
+            acq_func = acquisitions.var_opt_full
         else:
-            acq_func = gl.active_learning.sigma_opt
+            acq_func = acquisitions.sigma_opt_full
+        V = None
+        if model.graph.num_nodes > COV_EXACT_MAX_NODES:
+            V = get_eig_data(model.graph, normalization, numeigs)[1]
             
-        AL = gl.active_learning.active_learner(model, acq_func, labeled_ind.copy(), labeled_ind_labels.copy(), C=C.copy(), gamma2=args.gamma**2.)
+        AL = gl.active_learning.active_learner(model, acq_func, labeled_ind.copy(), labeled_ind_labels.copy(), graph=model.graph, 
+                                               delta=0.001, gamma2=args.gamma**2., normalization=normalization, cache_dir=CACHE_DIR,
+                                               evecs=V)
     
     else:
         acq_func, unc_method = get_unc_acq_func(af_name)
@@ -198,8 +289,9 @@ def get_graph_and_models(acq_funcs_names, model_names, args):
 
     # Load in the graph and labels
     print("Loading in Graph...")
-    G, labels, trainset, normalization, K = load_graph(args.dataset, args.metric, maxnumeigs, returnK=True)
+    G, labels, trainset, normalization, K = load_graph(args.dataset, args.metric, maxnumeigs, returnK=True, 
+                                                       knn_method=getattr(args, "knnmethod", None), knn_recall=getattr(args, "knnrecall", 0.95))
     
-    models = get_models(G, model_names)
+    models = get_models(G, model_names, propcache=getattr(args, "propcache", 0.), sparsetopk=getattr(args, "sparsetopk", 0) or None)
     
     return models, labels, trainset, normalization,  K